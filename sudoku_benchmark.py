@@ -0,0 +1,186 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import sudoku_solver
+
+# Number of clues left in the generated puzzles of every difficulty
+DIFFICULTY_CLUES = {'easy': 40, 'medium': 32, 'hard': 26}
+PERCENTILES = (50, 90, 99)
+
+
+def load_folder(puzzles_folder):
+    '''Load every puzzle file of the folder, in sorted order'''
+    return [sudoku_solver.load_sudoku(os.path.join(puzzles_folder, puzzle_file))
+            for puzzle_file in sorted(os.listdir(puzzles_folder))]
+
+
+def random_solution(rng):
+    '''Get a random solved 9 x 9 grid: a solution of the empty grid with its rows, columns, bands, stacks
+    and values shuffled'''
+    solved, grid, guesses = sudoku_solver.solve_with_exact_cover([[-1] * 9 for _ in range(9)])
+    values = list(range(9))
+    rng.shuffle(values)
+    bands, stacks = rng.sample(range(3), 3), rng.sample(range(3), 3)
+    rows = [band * 3 + row for band in bands for row in rng.sample(range(3), 3)]
+    cols = [stack * 3 + col for stack in stacks for col in rng.sample(range(3), 3)]
+    return [[values[grid[row][col]] for col in cols] for row in rows]
+
+
+def generate_corpus(difficulty, count, seed=0):
+    '''Generate count puzzles of a difficulty from DIFFICULTY_CLUES by emptying random cells of random
+    solutions; the puzzles are solvable but not always unique'''
+    rng = random.Random('%s-%d' % (difficulty, seed))
+    puzzles = []
+    for _ in range(count):
+        sudoku = random_solution(rng)
+        for idx in rng.sample(range(81), 81 - DIFFICULTY_CLUES[difficulty]):
+            sudoku[idx // 9][idx % 9] = -1
+        puzzles.append(sudoku)
+    return puzzles
+
+
+def percentile(values, q):
+    '''The q-th percentile of values (nearest rank)'''
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    summary = {'p%d' % q: percentile(values, q) for q in PERCENTILES}
+    summary['max'] = max(values)
+    summary['mean'] = sum(values) / len(values)
+    return summary
+
+
+def benchmark_strategy(strategy, puzzles, repeat=1):
+    '''Run strategy on every puzzle and measure it
+    input:  strategy: one of the solve_* functions
+            puzzles: the list of sudokus
+            repeat: number of timed runs per puzzle, the fastest one is kept
+    output: a dict with the latency (seconds) and guesses percentiles, the throughput (puzzles per second),
+            the largest tracemalloc peak (bytes) of a single solve, and the SolveStats of all the puzzles
+            with the nodes per second'''
+    latencies, guesses = [], []
+    for sudoku in puzzles:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            solved, solved_sudoku, puzzle_guesses = strategy(sudoku)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if not solved:
+            raise RuntimeError('%s did not solve a puzzle' % strategy.__name__)
+        latencies.append(best)
+        guesses.append(puzzle_guesses)
+
+    # Memory and stats are measured in a separate pass, tracemalloc and the instrumentation slow everything down
+    peak = 0
+    stats = sudoku_solver.SolveStats()
+    tracemalloc.start()
+    try:
+        for sudoku in puzzles:
+            puzzle_stats = sudoku_solver.SolveStats()
+            tracemalloc.reset_peak()
+            strategy(sudoku, stats=puzzle_stats)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            stats.add(puzzle_stats)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'puzzles': len(puzzles),
+        'throughput': len(puzzles) / sum(latencies),
+        'latency': summarize(latencies),
+        'guesses': summarize(guesses),
+        'peak_memory': peak,
+        'nodes_per_second': stats.nodes / sum(latencies),
+        'stats': stats.as_dict(),
+    }
+
+
+def run_benchmark(corpora, strategies, repeat=1, log=None):
+    '''Benchmark every strategy on every corpus
+    input:  corpora: dict name -> list of sudokus
+            strategies: names from sudoku_solver.STRATEGIES
+            repeat: see benchmark_strategy
+            log: file to print the progress to, None for no output
+    output: dict corpus name -> strategy name -> the dict of benchmark_strategy'''
+    results = {}
+    for corpus_name, puzzles in corpora.items():
+        results[corpus_name] = {}
+        for name in strategies:
+            result = benchmark_strategy(sudoku_solver.STRATEGIES[name], puzzles, repeat)
+            results[corpus_name][name] = result
+            if log is not None:
+                print('%-8s %-12s %9.1f puzzles/s  p50 %8.2f ms  p99 %8.2f ms  p50 guesses %6d  peak %7.1f KiB'
+                      '  %9.0f nodes/s' % (
+                          corpus_name, name, result['throughput'], result['latency']['p50'] * 1000,
+                          result['latency']['p99'] * 1000, result['guesses']['p50'], result['peak_memory'] / 1024,
+                          result['nodes_per_second']), file=log)
+    return results
+
+
+def compare_results(baseline, results, threshold):
+    '''Get the regressions of results against baseline
+    input:  baseline, results: outputs of run_benchmark
+            threshold: the largest accepted relative throughput drop, 0.1 for 10%
+    output: a list of messages, one per (corpus, strategy) that got slower than the threshold allows'''
+    regressions = []
+    for corpus_name, strategies in results.items():
+        for name, result in strategies.items():
+            if name not in baseline.get(corpus_name, {}):
+                continue
+            before = baseline[corpus_name][name]['throughput']
+            after = result['throughput']
+            if after < before * (1 - threshold):
+                regressions.append('%s/%s: %.1f -> %.1f puzzles/s (%.1f%% slower)' % (
+                    corpus_name, name, before, after, 100 * (1 - after / before)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the solver strategies')
+    parser.add_argument('--puzzles', default='puzzles', help='folder with the puzzle files, benchmarked as "folder"')
+    parser.add_argument('--generate', type=int, default=20, help='puzzles to generate per difficulty, 0 for none')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategies', default=','.join(s for s in sudoku_solver.STRATEGIES if s != 'backtracking'),
+                        help='comma separated strategies out of ' + ', '.join(sudoku_solver.STRATEGIES))
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per puzzle, the fastest is kept')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON baseline to compare the throughput with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='accepted throughput drop, 0.1 for 10%%')
+    args = parser.parse_args(argv)
+
+    strategies = args.strategies.split(',')
+    for name in strategies:
+        if name not in sudoku_solver.STRATEGIES:
+            parser.error('unknown strategy: ' + name)
+    corpora = {'folder': load_folder(args.puzzles)}
+    if args.generate:
+        for difficulty in DIFFICULTY_CLUES:
+            corpora[difficulty] = generate_corpus(difficulty, args.generate, args.seed)
+
+    results = run_benchmark(corpora, strategies, args.repeat, log=sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as output_f:
+            json.dump(results, output_f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_f:
+            baseline = json.load(baseline_f)
+        regressions = compare_results(baseline, results, args.threshold)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import itertools
+import sqlite3
+from collections import OrderedDict
+
+import sudoku_solver
+
+# Upper bound on the transformations canonical_form compares for a 9 x 9 puzzle, the larger boards get
+# proportionally fewer so that the work stays the same; very symmetric puzzles can have more, they then get a
+# form that only the puzzles with the same layout share (a cache miss, never a wrong hit)
+MAX_TRANSFORMS = 5000
+
+
+def line_orders(grid, box_size):
+    '''Get the orders of the rows of grid that sort the bands, and the rows inside every band, by a key that
+    does not change under the symmetries of the sudoku (clue counts of the row and of the columns it has clues in)
+    input:  grid: the sudoku as a list of lists where -1 represents an empty cell
+            box_size: number of rows in a band
+    output: band_keys: the sorted band keys, to compare the orientations
+            orders: a generator of the candidate row orders, each a tuple of row numbers; there can be
+                    billions of them on the large boards, so they are only built as they are taken'''
+    n = len(grid)
+    col_counts = [sum(grid[row][col] != -1 for row in range(n)) for col in range(n)]
+    row_keys = [(sum(value != -1 for value in grid[row]),
+                 tuple(sorted(col_counts[col] for col in range(n) if grid[row][col] != -1))) for row in range(n)]
+    bands = [tuple(range(band * box_size, (band + 1) * box_size)) for band in range(box_size)]
+    band_keys = [tuple(sorted(row_keys[row] for row in band)) for band in bands]
+
+    def orders():
+        for band_order in sorted_permutations(list(range(box_size)), band_keys):
+            for rows in lazy_product([lambda band=band: sorted_permutations(list(bands[band]), row_keys)
+                                      for band in band_order]):
+                yield tuple(row for band_rows in rows for row in band_rows)
+    return tuple(sorted(band_keys)), orders()
+
+
+def lazy_product(factories):
+    '''Generate the tuples of itertools.product(*[factory() for factory in factories]) in the same order, but
+    call the factories again instead of storing their items, so that the first tuples come without building
+    the others'''
+    if not factories:
+        yield ()
+        return
+    for first in factories[0]():
+        for rest in lazy_product(factories[1:]):
+            yield (first,) + rest
+
+
+def sorted_permutations(items, keys):
+    '''Generate every order of items that is sorted by keys[item], items with equal keys can come in any order'''
+    items = sorted(items, key=lambda item: keys[item])
+    groups = [list(group) for _, group in itertools.groupby(items, key=lambda item: keys[item])]
+    for parts in lazy_product([lambda group=group: itertools.permutations(group) for group in groups]):
+        yield tuple(item for part in parts for item in part)
+
+
+def canonical_form(sudoku):
+    '''Reduce the sudoku to a canonical form under transposition, band/stack permutations, row/column
+    permutations inside bands/stacks and relabelling of the values. Equivalent puzzles get the same form.
+    input:  sudoku: the sudoku as a list of lists where -1 represents an empty cell and 0-8 the values
+    output: key: the canonical form as a string, one character per cell
+            transform: (transposed, row_order, col_order, labels) to map grids between the caller's
+                       orientation and the canonical one, see to_canonical and from_canonical'''
+    n = len(sudoku)
+    box_size = sudoku_solver.get_board_geometry(n).box_size
+    transposed_sudoku = [list(col) for col in zip(*sudoku)]
+
+    orientations = []
+    for transposed, grid in ((False, sudoku), (True, transposed_sudoku)):
+        band_keys, row_orders = line_orders(grid, box_size)
+        stack_keys, col_orders = line_orders([list(col) for col in zip(*grid)], box_size)
+        orientations.append(((band_keys, stack_keys), transposed, grid, row_orders, col_orders))
+    best_signature = min(orientation[0] for orientation in orientations)
+    max_transforms = max(1, MAX_TRANSFORMS * 81 // (n * n))
+
+    best, best_transform = None, None
+    tried = 0
+    for signature, transposed, grid, row_orders, col_orders in orientations:
+        if signature != best_signature:
+            continue
+        # Every row order is tried with the same column orders, never more than max_transforms of them
+        col_orders = list(itertools.islice(col_orders, max_transforms))
+        for row_order in row_orders:
+            for col_order in col_orders:
+                labels = {}
+                form = []
+                for row in row_order:
+                    grid_row = grid[row]
+                    for col in col_order:
+                        value = grid_row[col]
+                        if value == -1:
+                            form.append(0)
+                        else:
+                            if value not in labels:
+                                labels[value] = len(labels) + 1
+                            form.append(labels[value])
+                if best is None or form < best:
+                    best, best_transform = form, (transposed, row_order, col_order, labels)
+                tried += 1
+                if tried >= max_transforms:
+                    break
+            if tried >= max_transforms:
+                break
+    return ''.join(chr(ord('0') + label) for label in best), best_transform
+
+
+def full_labels(labels, n):
+    '''Extend the labels of the values in the puzzle to all n values, the missing ones in increasing order'''
+    labels = dict(labels)
+    for value in range(n):
+        if value not in labels:
+            labels[value] = len(labels) + 1
+    return labels
+
+
+def to_canonical(solution, transform):
+    '''Map a grid of the caller's orientation to the canonical orientation and labels (1 to n)'''
+    transposed, row_order, col_order, labels = transform
+    labels = full_labels(labels, len(solution))
+    grid = [list(col) for col in zip(*solution)] if transposed else solution
+    return [[labels[grid[row][col]] for col in col_order] for row in row_order]
+
+
+def from_canonical(canonical_solution, transform):
+    '''Map a canonical grid (labels 1 to n) back to the caller's orientation and values (0 to n - 1)'''
+    transposed, row_order, col_order, labels = transform
+    n = len(canonical_solution)
+    values = {label: value for value, label in full_labels(labels, n).items()}
+    grid = [[-1] * n for _ in range(n)]
+    for i, row in enumerate(row_order):
+        for j, col in enumerate(col_order):
+            grid[row][col] = values[canonical_solution[i][j]]
+    return [list(col) for col in zip(*grid)] if transposed else grid
+
+
+def grid_to_string(grid):
+    '''One character per cell, '0' for an empty cell and '1' onwards for the values'''
+    return ''.join(chr(ord('1') + value) for row in grid for value in row)
+
+
+def string_to_grid(text, n):
+    '''Inverse of grid_to_string'''
+    return [[ord(text[row * n + col]) - ord('1') for col in range(n)] for row in range(n)]
+
+
+class SolutionCache:
+    '''Cache of solutions in front of the solve_* functions. A puzzle is looked up as it is, then by its
+    canonical form in an in-memory LRU, then in an optional SQLite file that persists between runs.
+    An unsolvable puzzle is cached too.
+        path: the SQLite file, None to keep the cache in memory only
+        max_entries: the size of each in-memory LRU
+    '''
+
+    def __init__(self, path=None, max_entries=4096):
+        self.max_entries = max_entries
+        # puzzle string -> solution string in the caller's orientation, '' if unsolvable
+        self.exact = OrderedDict()
+        # canonical form -> canonical solution string, '' if unsolvable
+        self.canonical = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS solutions (puzzle TEXT PRIMARY KEY, solution TEXT)')
+            self.connection.commit()
+
+    def remember(self, lru, key, value):
+        '''Insert key in lru as the most recently used entry and evict the least recently used ones'''
+        lru[key] = value
+        lru.move_to_end(key)
+        while len(lru) > self.max_entries:
+            lru.popitem(last=False)
+
+    def lookup_canonical(self, key):
+        '''Get the canonical solution string of the canonical form key, None if it is not cached'''
+        if key in self.canonical:
+            self.canonical.move_to_end(key)
+            return self.canonical[key]
+        if self.connection is not None:
+            row = self.connection.execute('SELECT solution FROM solutions WHERE puzzle = ?', (key,)).fetchone()
+            if row is not None:
+                self.remember(self.canonical, key, row[0])
+                return row[0]
+        return None
+
+    def store_canonical(self, key, solution):
+        self.remember(self.canonical, key, solution)
+        if self.connection is not None:
+            self.connection.execute('INSERT OR REPLACE INTO solutions VALUES (?, ?)', (key, solution))
+            self.connection.commit()
+
+    def solve(self, original_sudoku, strategy=sudoku_solver.solve_with_ac3, **strategy_kwargs):
+        '''Solve the sudoku with strategy unless it is cached
+        input:  original_sudoku: the sudoku to solve
+                strategy: one of the solve_* functions, run on a cache miss with strategy_kwargs
+        output: solved, sudoku, guesses like the solve_* functions (0 guesses on a hit)'''
+        n = len(original_sudoku)
+        puzzle = grid_to_string(original_sudoku)
+        if puzzle in self.exact:
+            self.exact.move_to_end(puzzle)
+            self.hits += 1
+            solution = self.exact[puzzle]
+            if solution == '':
+                return False, [row[:] for row in original_sudoku], 0
+            return True, string_to_grid(solution, n), 0
+
+        key, transform = canonical_form(original_sudoku)
+        canonical_solution = self.lookup_canonical(key)
+        if canonical_solution is not None:
+            self.hits += 1
+            if canonical_solution == '':
+                self.remember(self.exact, puzzle, '')
+                return False, [row[:] for row in original_sudoku], 0
+            sudoku = from_canonical(string_to_grid(canonical_solution, n), transform)
+            self.remember(self.exact, puzzle, grid_to_string(sudoku))
+            return True, sudoku, 0
+
+        self.misses += 1
+        solved, sudoku, guesses = strategy(original_sudoku, **strategy_kwargs)
+        if solved:
+            self.store_canonical(key, grid_to_string(to_canonical(sudoku, transform)))
+            self.remember(self.exact, puzzle, grid_to_string(sudoku))
+        elif solved is False:
+            self.store_canonical(key, '')
+            self.remember(self.exact, puzzle, '')
+        return solved, sudoku, guesses
+
+    def wrap(self, strategy):
+        '''Get a function with the signature of strategy that goes through the cache'''
+        def cached_strategy(original_sudoku, **strategy_kwargs):
+            return self.solve(original_sudoku, strategy, **strategy_kwargs)
+        return cached_strategy
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
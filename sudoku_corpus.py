@@ -0,0 +1,245 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+import sudoku_solver
+
+# File header: magic, version, board size, flags, reserved byte, number of puzzles
+HEADER = struct.Struct('<4sBBBBQ')
+MAGIC = b'SDKC'
+VERSION = 1
+# Set in the flags when every record has a solution slot after the puzzle
+HAS_SOLUTIONS = 1
+# Every cell takes 4 bits, 0 for an empty cell and value + 1 otherwise, so the boards go up to 9 x 9
+MAX_SIZE = 9
+# Puzzles encoded at once by write_corpus
+WRITE_CHUNK = 4096
+
+
+def cell_bytes(size):
+    '''Bytes taken by a grid of the size, two cells per byte (41 for 9 x 9)'''
+    return (size * size + 1) // 2
+
+
+def encode(grids):
+    '''Pack grids into bytes, two cells per byte with the first cell in the low nibble
+    input:  grids: int array (or nested lists) of shape (N, size, size), -1 for an empty cell
+    output: uint8 array of shape (N, cell_bytes(size))'''
+    grids = np.asarray(grids, dtype=np.int16)
+    count, size = grids.shape[0], grids.shape[1]
+    if size > MAX_SIZE:
+        raise ValueError('The corpus stores boards up to %d x %d, got %d x %d' % (MAX_SIZE, MAX_SIZE, size, size))
+    if grids.size and (grids.min() < -1 or grids.max() >= size):
+        raise ValueError('The cells must be -1 (empty) or a value from 0 to %d' % (size - 1))
+    nibbles = np.zeros((count, cell_bytes(size) * 2), dtype=np.uint8)
+    nibbles[:, :size * size] = grids.reshape(count, size * size) + 1
+    return nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+
+def decode(packed, size):
+    '''Unpack the output of encode (or records sliced from Corpus.records) into an int8 array of shape
+    (N, size, size) with -1 for an empty cell'''
+    packed = np.asarray(packed, dtype=np.uint8)
+    nibbles = np.empty((packed.shape[0], packed.shape[1] * 2), dtype=np.int8)
+    nibbles[:, 0::2] = packed & 0x0F
+    nibbles[:, 1::2] = packed >> 4
+    return (nibbles[:, :size * size] - 1).reshape(packed.shape[0], size, size)
+
+
+def write_corpus(path, puzzles, solutions=None, size=9):
+    '''Write puzzles to a corpus file
+    input:  path: the file to write
+            puzzles: an iterable of sudokus (lists of lists where -1 is an empty cell, or arrays)
+            solutions: None for no solution slot, else an iterable with the solution of every puzzle, or None
+                       for the puzzles without one (their slot is left empty)
+            size: the board size of every puzzle
+    output: the number of puzzles written'''
+    with_solutions = solutions is not None
+    empty = [[-1] * size for _ in range(size)]
+    count = 0
+    with open(path, 'wb') as corpus_f:
+        corpus_f.write(HEADER.pack(MAGIC, VERSION, size, HAS_SOLUTIONS if with_solutions else 0, 0, 0))
+        pairs = zip(puzzles, solutions) if with_solutions else ((puzzle, None) for puzzle in puzzles)
+        chunk, chunk_solutions = [], []
+        for puzzle, solution in pairs:
+            chunk.append(puzzle)
+            chunk_solutions.append(empty if solution is None else solution)
+            if len(chunk) == WRITE_CHUNK:
+                count += write_chunk(corpus_f, chunk, chunk_solutions if with_solutions else None, size)
+                chunk, chunk_solutions = [], []
+        if chunk:
+            count += write_chunk(corpus_f, chunk, chunk_solutions if with_solutions else None, size)
+        # The count is only known at the end, it goes back into the header
+        corpus_f.seek(0)
+        corpus_f.write(HEADER.pack(MAGIC, VERSION, size, HAS_SOLUTIONS if with_solutions else 0, 0, count))
+    return count
+
+
+def write_chunk(corpus_f, puzzles, solutions, size):
+    '''Append the records of puzzles (and of their solutions, if not None) to corpus_f'''
+    if any(len(puzzle) != size for puzzle in puzzles):
+        raise ValueError('Every puzzle of a corpus must be %d x %d' % (size, size))
+    records = encode(puzzles)
+    if solutions is not None:
+        records = np.concatenate([records, encode(solutions)], axis=1)
+    corpus_f.write(records.tobytes())
+    return len(puzzles)
+
+
+class Corpus:
+    '''Read-only view of a corpus file written by write_corpus, memory mapped so that opening it costs nothing
+    and any puzzle is read in O(1) without touching the others
+        records: uint8 array of shape (len(corpus), record bytes) over the mapping, slicing it copies nothing;
+                 the first cell_bytes(size) bytes of a record are the puzzle, the next ones the solution
+    Use it as a context manager or call close, which fails while views of records are still alive.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as corpus_f:
+            self.mapping = mmap.mmap(corpus_f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mapping) < HEADER.size:
+            self.mapping.close()
+            raise ValueError('Not a corpus file: ' + str(path))
+        magic, version, self.size, flags, _, self.count = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC or version != VERSION:
+            self.mapping.close()
+            raise ValueError('Not a corpus file of version %d: %s' % (VERSION, path))
+        self.has_solutions = bool(flags & HAS_SOLUTIONS)
+        self.grid_bytes = cell_bytes(self.size)
+        self.record_bytes = self.grid_bytes * (2 if self.has_solutions else 1)
+        if len(self.mapping) < HEADER.size + self.count * self.record_bytes:
+            self.mapping.close()
+            raise ValueError('Truncated corpus file: ' + str(path))
+        self.records = np.frombuffer(self.mapping, dtype=np.uint8, count=self.count * self.record_bytes,
+                                     offset=HEADER.size).reshape(self.count, self.record_bytes)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        '''The i-th puzzle as a list of lists, like load_sudoku'''
+        return decode(self.records[i, None, :self.grid_bytes], self.size)[0].tolist()
+
+    def solution(self, i):
+        '''The solution of the i-th puzzle as a list of lists, None if it has none'''
+        if not self.has_solutions:
+            return None
+        solution = decode(self.records[i, None, self.grid_bytes:], self.size)[0]
+        return None if solution[0, 0] == -1 else solution.tolist()
+
+    def puzzles(self, start=0, stop=None):
+        '''The puzzles start to stop (or at the indices in start, when it is a list or an array) as an int8 array
+        of shape (N, size, size), ready for sudokus_to_candidates'''
+        return decode(self.select(start, stop)[:, :self.grid_bytes], self.size)
+
+    def solutions(self, start=0, stop=None):
+        '''The solutions of the puzzles selected like in puzzles, with -1 everywhere for the puzzles without one'''
+        if not self.has_solutions:
+            raise ValueError('The corpus has no solutions')
+        return decode(self.select(start, stop)[:, self.grid_bytes:], self.size)
+
+    def select(self, start, stop):
+        if isinstance(start, (list, tuple, np.ndarray)):
+            return self.records[np.asarray(start, dtype=np.int64)]
+        return self.records[start:stop]
+
+    def shard(self, shard_id, shards):
+        '''The (start, stop) of the shard_id-th of shards contiguous shards of about the same size'''
+        return self.count * shard_id // shards, self.count * (shard_id + 1) // shards
+
+    def close(self):
+        self.records = None
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parse_line(line):
+    '''Parse a single-line dump: the cells in reading order ('1' to '9' for the values, '0' or '.' for an
+    empty cell), optionally followed by a comma or whitespace and the solution in the same form
+    output: (puzzle, solution), solution is None when the line has none'''
+    fields = line.replace(',', ' ').split()
+    grids = []
+    for field in fields[:2]:
+        size = int(round(len(field) ** 0.5))
+        if size * size != len(field):
+            raise ValueError('A dump line must have a square number of cells: ' + field)
+        cells = [-1 if char in '0.' else int(char) - 1 for char in field]
+        grids.append([cells[row * size:(row + 1) * size] for row in range(size)])
+    if not grids:
+        raise ValueError('Empty dump line')
+    return grids[0], grids[1] if len(grids) > 1 else None
+
+
+def solve_all(puzzles, strategy):
+    '''The solution of every puzzle with the named strategy, None for the ones it cannot solve'''
+    solve = sudoku_solver.STRATEGIES[strategy]
+    solutions = []
+    for puzzle in puzzles:
+        solved, solution, guesses = solve(puzzle)
+        solutions.append(solution if solved else None)
+    return solutions
+
+
+def convert_folder(puzzles_folder, path, strategy=None):
+    '''Write every puzzle file of the folder (in sorted order, read with load_sudoku) to a corpus file,
+    with their solutions by the named strategy if it is given
+    output: the number of puzzles written'''
+    puzzles = [sudoku_solver.load_sudoku(os.path.join(puzzles_folder, puzzle_file))
+               for puzzle_file in sorted(os.listdir(puzzles_folder))]
+    solutions = solve_all(puzzles, strategy) if strategy is not None else None
+    return write_corpus(path, puzzles, solutions, size=len(puzzles[0]) if puzzles else 9)
+
+
+def convert_lines(text_path, path, strategy=None):
+    '''Write the puzzles of a file of single-line dumps (see parse_line, blank lines and lines starting with
+    '#' are skipped) to a corpus file. The solutions in the dump are kept; with a strategy the missing ones
+    are computed, and without one a solution slot is only written if the dump has solutions.
+    output: the number of puzzles written'''
+    puzzles, solutions = [], []
+    with open(text_path) as text_f:
+        for line in text_f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            puzzle, solution = parse_line(line)
+            puzzles.append(puzzle)
+            solutions.append(solution)
+    if strategy is not None:
+        missing = [i for i, solution in enumerate(solutions) if solution is None]
+        for i, solution in zip(missing, solve_all([puzzles[i] for i in missing], strategy)):
+            solutions[i] = solution
+    if all(solution is None for solution in solutions):
+        solutions = None
+    return write_corpus(path, puzzles, solutions, size=len(puzzles[0]) if puzzles else 9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert puzzles to a packed corpus file')
+    parser.add_argument('source', help='a folder of puzzle files or a text file with one puzzle per line')
+    parser.add_argument('output', help='the corpus file to write')
+    parser.add_argument('--solve', metavar='STRATEGY',
+                        help='store the solutions found by this strategy out of ' + ', '.join(sudoku_solver.STRATEGIES))
+    args = parser.parse_args(argv)
+    if args.solve is not None and args.solve not in sudoku_solver.STRATEGIES:
+        parser.error('unknown strategy: ' + args.solve)
+
+    if os.path.isdir(args.source):
+        count = convert_folder(args.source, args.output, args.solve)
+    else:
+        count = convert_lines(args.source, args.output, args.solve)
+    print('%d puzzles, %d bytes' % (count, os.path.getsize(args.output)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
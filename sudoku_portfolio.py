@@ -0,0 +1,121 @@
+import json
+import multiprocessing
+import os
+import queue
+
+import sudoku_solver
+
+
+def run_strategy(name, sudoku, results):
+    '''Run the strategy name on the sudoku and put (name, (solved, sudoku, guesses)) on the results queue,
+    the target of the processes started by PortfolioSolver'''
+    results.put((name, sudoku_solver.STRATEGIES[name](sudoku)))
+
+
+class PortfolioSolver:
+    '''Races several strategies on the same puzzle, each in its own process, returns the result of the
+    first one to finish and terminates the others. The winners are counted by a cheap feature of the
+    puzzles (see features), which gives the order the strategies are started in when there are fewer
+    workers than strategies: the best ranked ones are raced first, and the next one is started whenever a
+    process exits without a result (a crash or an error). Once a strategy wins most races for a feature it
+    is run alone, in this process, for the puzzles with that feature.
+        strategies: names from sudoku_solver.STRATEGIES, DEFAULT_STRATEGIES by default
+        workers: number of strategies raced at once, all of them by default
+        min_races: races of a feature before a strategy can be chosen alone for it
+        confidence: share of those races a strategy must have won to be chosen alone, None to always race
+        path: JSON file the winners are loaded from and saved to, None to keep them in memory
+    '''
+
+    def __init__(self, strategies=None, workers=None, min_races=20, confidence=0.8, path=None):
+        if strategies is None:
+            strategies = sudoku_solver.DEFAULT_STRATEGIES
+        self.strategies = list(strategies)
+        self.workers = workers or len(self.strategies)
+        self.min_races = min_races
+        self.confidence = confidence
+        self.path = path
+        # feature -> strategy name -> number of races won
+        self.wins = {}
+        self.last_winner = None
+        if path is not None and os.path.exists(path):
+            with open(path) as wins_f:
+                self.wins = json.load(wins_f)
+
+    @staticmethod
+    def features(sudoku):
+        '''The feature the winners are counted by: the number of clues, in buckets of 4'''
+        clues = sum(value != -1 for row in sudoku for value in row)
+        return 'clues-%d' % (clues // 4 * 4)
+
+    def ordering(self, feature):
+        '''The strategies from the most to the least races won for the feature, then overall'''
+        feature_wins = self.wins.get(feature, {})
+        total_wins = {}
+        for counts in self.wins.values():
+            for name, count in counts.items():
+                total_wins[name] = total_wins.get(name, 0) + count
+        return sorted(self.strategies, key=lambda name: (-feature_wins.get(name, 0), -total_wins.get(name, 0),
+                                                         self.strategies.index(name)))
+
+    def choose(self, feature):
+        '''The strategy to run alone for the feature, None to race them'''
+        if self.confidence is None:
+            return None
+        counts = {name: count for name, count in self.wins.get(feature, {}).items() if name in self.strategies}
+        races = sum(counts.values())
+        if races < self.min_races:
+            return None
+        best = max(counts, key=counts.get)
+        return best if counts[best] >= self.confidence * races else None
+
+    def record(self, feature, name):
+        counts = self.wins.setdefault(feature, {})
+        counts[name] = counts.get(name, 0) + 1
+
+    def race(self, sudoku, names):
+        '''Run the strategies names in parallel processes, at most workers at once in the order of names, and
+        get the (name, result) of the first to finish'''
+        results = multiprocessing.Queue()
+        pending = list(names)
+        processes = []
+        try:
+            while True:
+                # A process that exited without putting a result frees its worker for the next strategy
+                running = sum(process.is_alive() for process in processes)
+                while pending and running < self.workers:
+                    process = multiprocessing.Process(target=run_strategy, args=(pending.pop(0), sudoku, results),
+                                                      daemon=True)
+                    process.start()
+                    processes.append(process)
+                    running += 1
+                try:
+                    return results.get(timeout=0.1)
+                except queue.Empty:
+                    if not pending and not any(process.is_alive() for process in processes) and results.empty():
+                        raise RuntimeError('every strategy of the race failed')
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join()
+            results.close()
+
+    def solve(self, original_sudoku):
+        '''Solve the sudoku with the chosen strategy or the winner of a race, last_winner is set to its name
+        output: solved, sudoku, guesses like the solve_* functions'''
+        feature = self.features(original_sudoku)
+        name = self.choose(feature)
+        if name is not None:
+            self.last_winner = name
+            return sudoku_solver.STRATEGIES[name](original_sudoku)
+        name, result = self.race(original_sudoku, self.ordering(feature))
+        self.record(feature, name)
+        self.last_winner = name
+        return result
+
+    def save(self):
+        '''Write the winners to path'''
+        if self.path is not None:
+            with open(self.path, 'w') as wins_f:
+                json.dump(self.wins, wins_f, indent=2, sort_keys=True)
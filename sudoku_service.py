@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import bisect
+import inspect
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import sudoku_solver
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket counts everything above
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds of completions the recent throughput is computed over
+THROUGHPUT_WINDOW = 10.0
+# Largest board accepted (25 x 25), the geometry of larger boards takes seconds to build and tens of MiB to keep
+MAX_BOARD_SIZE = 25
+# Start method of the worker processes: forked from the service, they would inherit the client sockets and keep
+# the connections open after the service closes them
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# The strategies that stop at a deadline, the others only check it before they start
+DEADLINE_STRATEGIES = {name for name, strategy in sudoku_solver.STRATEGIES.items()
+                       if 'deadline' in inspect.signature(strategy).parameters}
+
+
+def solve_requests(requests):
+    '''Solve a batch of requests, run in the worker processes
+    input:  requests: a list of (strategy name, sudoku, deadline), deadline is a time.monotonic() value
+            or None; the monotonic clock is shared by the processes of the machine
+    output: a list with the (status, sudoku, guesses) of every request, status is 'solved', 'unsolvable',
+            'timeout' or 'error', sudoku is the solution when it is solved, the error message on an error and
+            None otherwise'''
+    results = []
+    for name, sudoku, deadline in requests:
+        if deadline is not None and time.monotonic() >= deadline:
+            results.append(('timeout', None, 0))
+            continue
+        try:
+            if name in DEADLINE_STRATEGIES:
+                solved, solved_sudoku, guesses = sudoku_solver.STRATEGIES[name](sudoku, deadline=deadline)
+            else:
+                solved, solved_sudoku, guesses = sudoku_solver.STRATEGIES[name](sudoku)
+        except Exception as error:
+            # One bad puzzle must not fail the others of the batch
+            results.append(('error', repr(error), 0))
+            continue
+        if solved is None:
+            results.append(('timeout', None, guesses))
+        elif solved:
+            results.append(('solved', solved_sudoku, guesses))
+        else:
+            results.append(('unsolvable', None, guesses))
+    return results
+
+
+def check_sudoku(sudoku):
+    '''Raise ValueError unless sudoku is an n x n list of lists of values from -1 to n - 1 on a supported board'''
+    if not isinstance(sudoku, list) or not all(isinstance(row, list) and len(row) == len(sudoku) for row in sudoku):
+        raise ValueError('sudoku must be a square list of lists')
+    n = len(sudoku)
+    if not 1 <= n <= MAX_BOARD_SIZE:
+        raise ValueError('the board must have from 1 to %d rows, got %d' % (MAX_BOARD_SIZE, n))
+    sudoku_solver.get_board_geometry(n)
+    for row in sudoku:
+        for value in row:
+            if not isinstance(value, int) or isinstance(value, bool) or not -1 <= value < n:
+                raise ValueError('the cells must be -1 (empty) or a value from 0 to %d' % (n - 1))
+
+
+class Histogram:
+    '''Counts of observations in fixed buckets: counts[i] is the number of values up to bounds[i] (and above
+    the previous bound), the last count the number of values above every bound'''
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        return {'bounds': self.bounds, 'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+
+class ServiceMetrics:
+    '''The counters of a SolverService, see as_dict for what is reported'''
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.received = 0
+        self.statuses = {'solved': 0, 'unsolvable': 0, 'timeout': 0, 'error': 0}
+        self.batches = 0
+        self.batched = 0
+        self.worker_restarts = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        # time.monotonic() of the completions of the last THROUGHPUT_WINDOW seconds
+        self.recent = deque()
+
+    def batch(self, size):
+        self.batches += 1
+        self.batched += size
+
+    def complete(self, status, latency):
+        now = time.monotonic()
+        self.statuses[status] += 1
+        self.latency.observe(latency)
+        self.recent.append(now)
+        while self.recent[0] < now - THROUGHPUT_WINDOW:
+            self.recent.popleft()
+
+    def as_dict(self, queue_depth, queue_size, in_flight):
+        now = time.monotonic()
+        while self.recent and self.recent[0] < now - THROUGHPUT_WINDOW:
+            self.recent.popleft()
+        uptime = now - self.started
+        completed = sum(self.statuses.values())
+        return {
+            'uptime': uptime,
+            'received': self.received,
+            'completed': completed,
+            'statuses': dict(self.statuses),
+            'queue_depth': queue_depth,
+            'queue_size': queue_size,
+            'in_flight': in_flight,
+            'batches': self.batches,
+            'mean_batch_size': self.batched / self.batches if self.batches else 0.0,
+            'worker_restarts': self.worker_restarts,
+            'throughput': completed / uptime if uptime > 0 else 0.0,
+            'recent_throughput': len(self.recent) / min(uptime, THROUGHPUT_WINDOW) if uptime > 0 else 0.0,
+            'latency': self.latency.as_dict(),
+            'queue_wait': self.queue_wait.as_dict(),
+        }
+
+
+class Connection:
+    '''A client of the service: its writer and the number of its requests that are not answered yet, idle is
+    set while there are none'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def add(self):
+        self.pending += 1
+        self.idle.clear()
+
+    def done(self):
+        self.pending -= 1
+        if not self.pending:
+            self.idle.set()
+
+
+class SolverService:
+    '''A local solving service speaking JSON lines over TCP or a Unix socket. Every line sent to it is a request
+    and gets one response line with the same "id", in the order the requests complete:
+        {"id": 1, "sudoku": [[...], ...], "strategy": "ac3", "timeout": 0.5}
+            sudoku: the puzzle as a list of lists where -1 is an empty cell, strategy and timeout (seconds
+            from the reception of the request) are optional
+            -> {"id": 1, "status": "solved", "sudoku": [[...], ...], "guesses": 0, "latency": 0.002}
+            status is "solved", "unsolvable", "timeout" or "error" (with an "error" message)
+        {"id": 2, "op": "metrics"}
+            -> {"id": 2, "status": "ok", "metrics": {...}}, see ServiceMetrics.as_dict
+    A client may stop sending (half-close) and still read the responses of its requests, the connection is
+    closed once they are all written.
+    The puzzles wait in a bounded queue, once it is full the connections are not read anymore until there is
+    room again (backpressure). They are taken from it in batches of up to batch_size, waiting batch_delay
+    seconds for a batch to fill, and every batch is solved by one of the worker processes; at most workers
+    batches are solved at once so that the waiting puzzles stay in the queue.
+        workers: number of worker processes, None or 0 uses every cpu
+        strategy: the name from sudoku_solver.STRATEGIES used when a request has none
+        batch_size, batch_delay: see above
+        queue_size: the number of puzzles that can wait for a worker
+        timeout: the timeout of the requests that have none, None for no limit
+    '''
+
+    def __init__(self, workers=None, strategy='ac3', batch_size=16, batch_delay=0.005, queue_size=1024,
+                 timeout=None):
+        if strategy not in sudoku_solver.STRATEGIES:
+            raise ValueError('Unknown strategy: ' + str(strategy))
+        self.workers = workers or os.cpu_count()
+        self.strategy = strategy
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.metrics = ServiceMetrics()
+        self.queue = None
+        self.slots = None
+        self.executor = None
+        self.server = None
+        self.dispatcher = None
+        self.in_flight = 0
+        self.batch_tasks = set()
+        self.handlers = set()
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        '''Start the worker processes and listen on path (a Unix socket) if it is given, else on host:port'''
+        self.queue = asyncio.Queue(self.queue_size)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context(START_METHOD))
+        self.dispatcher = asyncio.create_task(self.dispatch())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def close(self):
+        '''Stop listening, answer the batches being solved, close the connections and stop the workers, the queued
+        puzzles are dropped'''
+        if self.server is not None:
+            self.server.close()
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+        if self.batch_tasks:
+            await asyncio.gather(*self.batch_tasks, return_exceptions=True)
+        for handler in self.handlers:
+            handler.cancel()
+        if self.handlers:
+            await asyncio.gather(*self.handlers, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def restart_workers(self, broken):
+        '''Replace the executor broken by a worker that died (killed, out of memory), unless a batch that
+        failed with it at the same time already did'''
+        if self.executor is not broken:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context(START_METHOD))
+        self.metrics.worker_restarts += 1
+
+    def get_metrics(self):
+        return self.metrics.as_dict(self.queue.qsize(), self.queue_size, self.in_flight)
+
+    async def respond(self, writer, response):
+        '''Write one response line, unless the client is gone'''
+        if writer.is_closing():
+            return
+        writer.write(json.dumps(response).encode() + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_connection(self, reader, writer):
+        '''Read the requests of a connection until the client stops sending, the responses are written by the
+        batches and the connection is closed after the last one'''
+        connection = Connection(writer)
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError):
+                    # A line longer than the reader limit, or a reset connection
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                received = time.monotonic()
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('a request must be a JSON object')
+                except ValueError as error:
+                    await self.respond(writer, {'id': None, 'status': 'error', 'error': str(error)})
+                    continue
+                request_id = request.get('id')
+
+                if request.get('op', 'solve') == 'metrics':
+                    await self.respond(writer, {'id': request_id, 'status': 'ok', 'metrics': self.get_metrics()})
+                    continue
+                self.metrics.received += 1
+                try:
+                    if request.get('op', 'solve') != 'solve':
+                        raise ValueError('Unknown op: ' + str(request['op']))
+                    strategy = request.get('strategy', self.strategy)
+                    if strategy not in sudoku_solver.STRATEGIES:
+                        raise ValueError('Unknown strategy: ' + str(strategy))
+                    sudoku = request.get('sudoku')
+                    check_sudoku(sudoku)
+                    timeout = request.get('timeout', self.timeout)
+                    deadline = None if timeout is None else received + float(timeout)
+                except (ValueError, TypeError) as error:
+                    self.metrics.complete('error', time.monotonic() - received)
+                    await self.respond(writer, {'id': request_id, 'status': 'error', 'error': str(error)})
+                    continue
+
+                # Waits while the queue is full, the connection is not read meanwhile
+                connection.add()
+                await self.queue.put((connection, request_id, strategy, sudoku, received, deadline))
+            await connection.idle.wait()
+        except asyncio.CancelledError:
+            # Cancelled by close, the queued requests of the connection will not be answered
+            pass
+        finally:
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def dispatch(self):
+        '''Take the puzzles from the queue in batches and start a task solving every batch'''
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            if self.batch_delay and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            task = asyncio.create_task(self.solve_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def solve_batch(self, batch):
+        '''Solve a batch in a worker process and answer its requests, the slot taken by dispatch is released'''
+        try:
+            now = time.monotonic()
+            jobs = []
+            for job in batch:
+                connection, request_id, strategy, sudoku, received, deadline = job
+                self.metrics.queue_wait.observe(now - received)
+                if deadline is not None and now >= deadline:
+                    # Expired in the queue, not worth sending to a worker
+                    self.metrics.complete('timeout', now - received)
+                    await self.respond(connection.writer,
+                                       {'id': request_id, 'status': 'timeout', 'latency': now - received})
+                    connection.done()
+                else:
+                    jobs.append(job)
+            if not jobs:
+                return
+            self.metrics.batch(len(jobs))
+            self.in_flight += len(jobs)
+            executor = self.executor
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    executor, solve_requests, [(job[2], job[3], job[5]) for job in jobs])
+            except BrokenProcessPool as error:
+                # Only the batches running on the dead pool fail, the next ones get new workers
+                self.restart_workers(executor)
+                results = [('error', repr(error), 0)] * len(jobs)
+            except Exception as error:
+                results = [('error', repr(error), 0)] * len(jobs)
+            finally:
+                self.in_flight -= len(jobs)
+
+            now = time.monotonic()
+            for (connection, request_id, strategy, sudoku, received, deadline), (status, solution, guesses) in \
+                    zip(jobs, results):
+                latency = now - received
+                if deadline is not None and now >= deadline and status in ('solved', 'unsolvable'):
+                    # Finished too late for the client, the strategies without a deadline only check it first
+                    status, solution = 'timeout', None
+                self.metrics.complete(status, latency)
+                response = {'id': request_id, 'status': status, 'guesses': guesses, 'latency': latency}
+                if status == 'solved':
+                    response['sudoku'] = solution
+                elif status == 'error':
+                    response['error'] = solution
+                await self.respond(connection.writer, response)
+                connection.done()
+        finally:
+            self.slots.release()
+
+
+async def serve(service, host='127.0.0.1', port=8765, path=None):
+    '''Run the service until the task is cancelled'''
+    server = await service.start(host, port, path)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the solver over JSON lines on a local socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes, 0 for one per cpu')
+    parser.add_argument('--strategy', default='ac3',
+                        help='default strategy out of ' + ', '.join(sudoku_solver.STRATEGIES))
+    parser.add_argument('--batch-size', type=int, default=16, help='largest number of puzzles sent to a worker at once')
+    parser.add_argument('--batch-delay', type=float, default=0.005, help='seconds to wait for a batch to fill')
+    parser.add_argument('--queue-size', type=int, default=1024, help='puzzles waiting before the clients are blocked')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds per request when it sets none')
+    args = parser.parse_args(argv)
+    if args.strategy not in sudoku_solver.STRATEGIES:
+        parser.error('unknown strategy: ' + args.strategy)
+
+    service = SolverService(args.workers, args.strategy, args.batch_size, args.batch_delay, args.queue_size,
+                            args.timeout)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    main()
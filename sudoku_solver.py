@@ -1,19 +1,159 @@
 import os
+import time
+import argparse
+import functools
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import numpy as np
-import copy
+from collections import OrderedDict, deque
+
+# Names of the domain backends that can be selected through get_initial_kwargs
+# set: domains is a dict of sets keyed by (row, col)
+# bitmask: domains is a flat list of n * n integers where bit v is set if the value v is still possible
+SET_BACKEND = 'set'
+BITMASK_BACKEND = 'bitmask'
+DEFAULT_BACKEND = BITMASK_BACKEND
+
+# Largest board size whose tables are lists indexed by mask (65536 entries), larger boards compute the values
+MAX_TABLE_SIZE = 16
+
+
+class LargePopcount:
+    '''The popcount table of the boards larger than MAX_TABLE_SIZE, indexed like a list'''
+    __getitem__ = staticmethod(int.bit_count)
+
+
+class LargeLowestBit:
+    '''The lowest bit table of the boards larger than MAX_TABLE_SIZE, indexed like a list'''
+
+    def __getitem__(self, mask):
+        return (mask & -mask).bit_length() - 1
+
+
+class BoardGeometry:
+    '''The constraint structure of an n x n board, which does not depend on the values in the cells.
+    Cells are available both as (row, col) tuples for the set backend and as flat indices
+    (row * n + col) for the bitmask backend. Use get_board_geometry to get the shared instance.
+        size: number of rows (and columns, and values)
+        box_size: number of rows (and columns) in a box
+        cells: every (row, col) tuple in the order of the flat indices
+        cell_row, cell_col, cell_box: row, column and box of every flat index
+        units: all rows, then all columns, then all boxes as lists of (row, col) tuples
+        unit_indices: the same units as tuples of flat indices
+        units_of_cell: for every flat index, the positions in units of its row, column and box
+        unit_slots: for every flat index, a (unit, bit) pair for its row, column and box, where bit is
+                    1 << the position of the index in the unit
+        peers: for every (row, col), the frozenset of the cells sharing a unit with it
+        peer_indices: for every flat index, the tuple of the flat indices of its peers
+        arcs: all (cell, peer) pairs as (row, col) tuples
+        arc_indices: all (index, peer index) pairs, the position of a pair in the list is its arc id
+        incoming_arcs: for every flat index, the arc ids of the arcs (peer index, index) pointing at it
+        peer_matrix: float32 numpy matrix with a 1 at [idx, peer] for every peer, used by propagate_batch
+        unit_matrix: float32 numpy matrix with a 1 at [unit, idx] for every cell of every unit
+        all_values: the mask with the bits of all the values set
+        popcount, lowest_bit: the number of bits set and the lowest bit set of every mask, indexed by mask
+    '''
 
-def load_sudoku(puzzle_path):
+    def __init__(self, size):
+        self.size = size
+        self.box_size = int(round(np.sqrt(size)))
+        if self.box_size * self.box_size != size:
+            raise ValueError('The size of a board must be a square, got ' + str(size))
+        self.num_cells = size * size
+        n, b = size, self.box_size
+
+        self.all_values = (1 << n) - 1
+        if n <= MAX_TABLE_SIZE:
+            self.popcount = [mask.bit_count() for mask in range(1 << n)]
+            self.lowest_bit = [(mask & -mask).bit_length() - 1 for mask in range(1 << n)]
+        else:
+            self.popcount = LargePopcount()
+            self.lowest_bit = LargeLowestBit()
+
+        self.cells = [(idx // n, idx % n) for idx in range(n * n)]
+        self.cell_row = [idx // n for idx in range(n * n)]
+        self.cell_col = [idx % n for idx in range(n * n)]
+        self.cell_box = [(row // b) * b + col // b for row, col in zip(self.cell_row, self.cell_col)]
+
+        self.unit_indices = [tuple(row * n + col for col in range(n)) for row in range(n)]
+        self.unit_indices += [tuple(row * n + col for row in range(n)) for col in range(n)]
+        self.unit_indices += [tuple((box // b * b + i // b) * n + box % b * b + i % b for i in range(n))
+                              for box in range(n)]
+        self.units = [[(idx // n, idx % n) for idx in unit] for unit in self.unit_indices]
+        self.units_of_cell = [(self.cell_row[idx], n + self.cell_col[idx], 2 * n + self.cell_box[idx])
+                              for idx in range(n * n)]
+        self.unit_slots = [tuple((unit, 1 << self.unit_indices[unit].index(idx)) for unit in self.units_of_cell[idx])
+                           for idx in range(n * n)]
+
+        self.peer_indices = []
+        for idx in range(n * n):
+            peers = set()
+            for unit in self.units_of_cell[idx]:
+                peers.update(self.unit_indices[unit])
+            peers.remove(idx)
+            self.peer_indices.append(tuple(sorted(peers)))
+        self.peers = {}
+        for idx in range(n * n):
+            self.peers[(idx // n, idx % n)] = frozenset((peer // n, peer % n) for peer in self.peer_indices[idx])
+
+        self.arc_indices = [(idx, peer) for idx in range(n * n) for peer in self.peer_indices[idx]]
+        self.arcs = [((i // n, i % n), (j // n, j % n)) for i, j in self.arc_indices]
+        arc_ids = {arc: arc_id for arc_id, arc in enumerate(self.arc_indices)}
+        self.incoming_arcs = [tuple(arc_ids[(peer, idx)] for peer in self.peer_indices[idx]) for idx in range(n * n)]
+
+        self.peer_matrix = np.zeros((n * n, n * n), dtype=np.float32)
+        for idx in range(n * n):
+            self.peer_matrix[idx, list(self.peer_indices[idx])] = 1
+        self.unit_matrix = np.zeros((3 * n, n * n), dtype=np.float32)
+        for unit, indices in enumerate(self.unit_indices):
+            self.unit_matrix[unit, list(indices)] = 1
+
+
+_board_geometries = {}
+
+def get_board_geometry(size=9):
+    '''Get the BoardGeometry of a size x size board, it is built on the first call for every size'''
+    if size not in _board_geometries:
+        _board_geometries[size] = BoardGeometry(size)
+    return _board_geometries[size]
+
+# Built at import time, every 9 x 9 solve shares it
+GEOMETRY = get_board_geometry(9)
+# Lookup tables for the bitmask backend on 9 x 9 boards, the geometry of every size has its own
+ALL_VALUES_MASK = GEOMETRY.all_values
+POPCOUNT = GEOMETRY.popcount
+LOWEST_BIT = GEOMETRY.lowest_bit
+
+
+def load_sudoku(puzzle_path, symbols=None):
     ''' Load the sudoku from the given path; it returns the sudoku as a list of lists
-        input: puzzle_path: path to the puzzle
+        input: puzzle_path: path to the puzzle, one row per line with the cells separated by spaces
+               symbols: the symbols of the values in order (a string of single characters such as
+                        '123456789ABCDEFG', or a list of strings); by default the cells are numbers from 1 to n
+                        (several digits each for the large boards), 0 and anything that is not a number is an
+                        empty cell. With symbols, a cell that is not one of them is empty unless it is made of
+                        letters or digits other than 0.
         output: ret: the sudoku as a list of lists where -1 represents an empty cell
-        and 0-8 represents the value in the cell corresponding to the numbers 1-9'''
+        and 0 to n - 1 represents the value in the cell corresponding to the numbers 1 to n
+        A cell that is not a value of its n-cell row raises ValueError.'''
+    values = None if symbols is None else {symbol: value for value, symbol in enumerate(symbols)}
     ret = []
     with open(puzzle_path, 'r') as sudoku_f: 
         for line in sudoku_f:
-            line = line.rstrip()
-            cur = line.split(" ")
-            cur = [ord(x) - ord('1') if x.isdigit() else -1 for x in cur]
-            ret.append(cur)
+            cur = line.split()
+            if not cur:
+                continue
+            row = []
+            for col, x in enumerate(cur):
+                if values is not None:
+                    value = values.get(x, None if x.isalnum() and x != '0' else -1)
+                else:
+                    value = int(x) - 1 if x.isdigit() else -1
+                if value is None or value >= len(cur):
+                    raise ValueError('%s: row %d, column %d: %r is not a value of a %d x %d board'
+                                     % (puzzle_path, len(ret) + 1, col + 1, x, len(cur), len(cur)))
+                row.append(value)
+            ret.append(row)
     return ret
 
 
@@ -38,7 +178,14 @@ def undo_changes_for_position(sudoku, x, y, val, **kwargs):
                kwargs: other keyword arguments
         output: None
     '''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        # The assignment is the last entry of the trail, everything after it was undone by the waterfalls
+        trail = kwargs['trail']
+        trail.undo_to(trail.top - 1)
+        return
     sudoku[x][y] = -1
+    if 'saved_domains' in kwargs:
+        kwargs['domains'][(x, y)] = kwargs['saved_domains'].pop((x, y))
     # pass
 
 
@@ -51,7 +198,19 @@ def update_changes_for_position(sudoku, x, y, val, **kwargs):
                kwargs: other keyword arguments
         output: None
     '''
-    sudoku[x][y] = val
+    # The domain of an assigned cell is its value, AC-3 propagates it from there
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        cell = x * len(sudoku) + y
+        kwargs['trail'].assign(cell, val)
+    else:
+        sudoku[x][y] = val
+        if 'saved_domains' not in kwargs:
+            return
+        kwargs['saved_domains'][(x, y)] = kwargs['domains'][(x, y)]
+        kwargs['domains'][(x, y)] = set([val])
+        cell = (x, y)
+    if kwargs.get('ac3_dirty') is not None:
+        kwargs['ac3_dirty'].add(cell)
     # pass
 
 
@@ -64,6 +223,8 @@ def isPossible(sudoku, x, y, val, **kwargs):
                kwargs: other keyword arguments
         output: True if possible, False otherwise
     '''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return (get_candidates_bitmask(x, y, **kwargs) >> val) & 1 == 1
     
     domains = kwargs['domains']
     if val not in domains[(x,y)]:
@@ -74,13 +235,14 @@ def isPossible(sudoku, x, y, val, **kwargs):
         return False
 
     # check column
-    if val in [sudoku[i][y] for i in range(0, 9)]:
+    if val in [sudoku[i][y] for i in range(0, len(sudoku))]:
         return False
 
-    # check 3x3 box
-    box_row = (x // 3) * 3
-    box_col = (y // 3) * 3
-    if val in [sudoku[i][j] for i in range(box_row, box_row + 3) for j in range(box_col, box_col + 3)]:
+    # check box
+    box_size = kwargs.get('geometry', GEOMETRY).box_size
+    box_row = (x // box_size) * box_size
+    box_col = (y // box_size) * box_size
+    if val in [sudoku[i][j] for i in range(box_row, box_row + box_size) for j in range(box_col, box_col + box_size)]:
         return False
 
     # if the value is valid for the cell, return True
@@ -88,19 +250,38 @@ def isPossible(sudoku, x, y, val, **kwargs):
     # pass
 
 
+def get_candidates_bitmask(x, y, **kwargs):
+    ''' Get the values that are possible at the given position (x, y) with the bitmask backend
+        input: x: row number
+               y: column number
+               kwargs: other keyword arguments
+        output: mask: bit v is set if isPossible would return True for the value v
+    '''
+    geometry = kwargs.get('geometry', GEOMETRY)
+    idx = x * geometry.size + y
+    used = kwargs['row_used'][x] | kwargs['col_used'][y] | kwargs['box_used'][geometry.cell_box[idx]]
+    return kwargs['domains'][idx] & ~used
+
+
 def get_mrv_position(sudoku, **kwargs):
     ''' Get the position with minimum remaining values
         input: sudoku: the sudoku to be solved
                kwargs: other keyword arguments'
         output: x: row number
                 y: column number'''
+    n = len(sudoku)
+    if kwargs.get('mrv_index') is not None:
+        idx = kwargs['mrv_index'].select()
+        return (-1, -1) if idx < 0 else (idx // n, idx % n)
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return get_mrv_position_bitmask(sudoku, **kwargs)
     mrv_cell = (-1, -1)
-    min_remaining_values = 9
+    min_remaining_values = n
     remaining_values= 0
-    for row in range(0, 9):
-        for col in range(0, 9):
+    for row in range(0, n):
+        for col in range(0, n):
             if sudoku[row][col] == -1:
-                for i in range(9):
+                for i in range(n):
                     if isPossible(sudoku, row, col, i, **kwargs):
                         remaining_values += 1
                 if remaining_values < min_remaining_values:
@@ -111,16 +292,368 @@ def get_mrv_position(sudoku, **kwargs):
     # pass
 
 
+def get_mrv_position_bitmask(sudoku, **kwargs):
+    ''' Get the position with minimum remaining values with the bitmask backend
+        input: sudoku: the sudoku to be solved
+               kwargs: other keyword arguments
+        output: x: row number
+                y: column number'''
+    domains = kwargs['domains']
+    row_used, col_used, box_used = kwargs['row_used'], kwargs['col_used'], kwargs['box_used']
+    geometry = kwargs.get('geometry', GEOMETRY)
+    cell_row, cell_col, cell_box = geometry.cell_row, geometry.cell_col, geometry.cell_box
+    popcount, all_values = geometry.popcount, geometry.all_values
+    mrv_cell = (-1, -1)
+    min_remaining_values = geometry.size
+    for idx in range(geometry.num_cells):
+        row, col = cell_row[idx], cell_col[idx]
+        if sudoku[row][col] == -1:
+            used = row_used[row] | col_used[col] | box_used[cell_box[idx]]
+            remaining_values = popcount[domains[idx] & ~used & all_values]
+            if remaining_values < min_remaining_values:
+                mrv_cell = (row, col)
+                min_remaining_values = remaining_values
+    return mrv_cell
+
+
+
+class MRVIndex:
+    '''Keeps the unassigned cells of the bitmask backend in buckets keyed by their number of remaining values,
+    so that get_mrv_position does not need to scan the board. Every bucket is an integer with bit idx set for
+    the flat index idx, the lowest bit of the first non empty bucket is the cell the scan in
+    get_mrv_position_bitmask would return (cells with all n values left are never returned either).
+    The counts are recomputed from the domains and the used masks, so undoing a change is the same as
+    refreshing the cells it touched.
+        degree: break ties by the number of unassigned peers (largest first) instead of the position alone
+    '''
+
+    def __init__(self, sudoku, degree=False, **kwargs):
+        self.domains = kwargs['domains']
+        self.row_used, self.col_used, self.box_used = kwargs['row_used'], kwargs['col_used'], kwargs['box_used']
+        self.geometry = kwargs.get('geometry', GEOMETRY)
+        self.degree = degree
+        # -1 for the assigned cells
+        self.counts = [-1] * self.geometry.num_cells
+        self.buckets = [0] * (self.geometry.size + 1)
+        # Number of unassigned peers of every cell, only used by the degree heuristic
+        self.free_peers = [0] * self.geometry.num_cells
+        for idx in range(self.geometry.num_cells):
+            if sudoku[self.geometry.cell_row[idx]][self.geometry.cell_col[idx]] == -1:
+                self.insert(idx)
+                for peer in self.geometry.peer_indices[idx]:
+                    self.free_peers[peer] += 1
+
+    def count_remaining_values(self, idx):
+        '''Number of values that are possible at the flat index idx'''
+        geometry = self.geometry
+        used = self.row_used[geometry.cell_row[idx]] | self.col_used[geometry.cell_col[idx]] | \
+            self.box_used[geometry.cell_box[idx]]
+        return geometry.popcount[self.domains[idx] & ~used & geometry.all_values]
+
+    def insert(self, idx):
+        '''Add the unassigned cell idx to its bucket'''
+        count = self.count_remaining_values(idx)
+        self.counts[idx] = count
+        self.buckets[count] |= 1 << idx
+
+    def refresh(self, idx):
+        '''Move the cell idx to the right bucket after its domain or the values around it changed'''
+        old = self.counts[idx]
+        if old < 0:
+            return
+        count = self.count_remaining_values(idx)
+        if count != old:
+            self.buckets[old] &= ~(1 << idx)
+            self.buckets[count] |= 1 << idx
+            self.counts[idx] = count
+
+    def assign(self, idx):
+        '''Remove the cell idx that was just assigned and refresh its peers'''
+        self.buckets[self.counts[idx]] &= ~(1 << idx)
+        self.counts[idx] = -1
+        for peer in self.geometry.peer_indices[idx]:
+            self.free_peers[peer] -= 1
+            self.refresh(peer)
+
+    def unassign(self, idx):
+        '''Put back the cell idx whose assignment was just undone and refresh its peers'''
+        self.insert(idx)
+        for peer in self.geometry.peer_indices[idx]:
+            self.free_peers[peer] += 1
+            self.refresh(peer)
+
+    def select(self):
+        '''Get the flat index of the cell with minimum remaining values, -1 if there is none'''
+        for count in range(self.geometry.size):
+            bucket = self.buckets[count]
+            if bucket:
+                if not self.degree:
+                    return (bucket & -bucket).bit_length() - 1
+                best, best_degree = -1, -1
+                while bucket:
+                    idx = (bucket & -bucket).bit_length() - 1
+                    bucket &= bucket - 1
+                    if self.free_peers[idx] > best_degree:
+                        best, best_degree = idx, self.free_peers[idx]
+                return best
+        return -1
+
+
+class PositionIndex:
+    '''For every unit and value, the positions of the unit whose domain still has the value, the dual of the
+    domains of the bitmask backend. positions[unit * size + value] has bit i set if the value is in the domain
+    of the i-th cell of the unit (an assigned cell has its own value only). The Trail keeps it up to date
+    when it removes values and when it undoes changes, so a hidden single or a hidden pair is read from it
+    without scanning the cells of the unit.
+    '''
+
+    def __init__(self, **kwargs):
+        self.geometry = kwargs.get('geometry', GEOMETRY)
+        size = self.geometry.size
+        self.size = size
+        self.positions = [0] * (len(self.geometry.unit_indices) * size)
+        domains = kwargs['domains']
+        for idx in range(self.geometry.num_cells):
+            self.add(idx, domains[idx])
+
+    def add(self, idx, mask):
+        '''The values in mask were put back in the domain of the flat index idx'''
+        positions, size = self.positions, self.size
+        lowest_bit = self.geometry.lowest_bit
+        for unit, bit in self.geometry.unit_slots[idx]:
+            base = unit * size
+            values = mask
+            while values:
+                positions[base + lowest_bit[values]] |= bit
+                values &= values - 1
+
+    def remove(self, idx, mask):
+        '''The values in mask were removed from the domain of the flat index idx'''
+        positions, size = self.positions, self.size
+        lowest_bit = self.geometry.lowest_bit
+        for unit, bit in self.geometry.unit_slots[idx]:
+            base = unit * size
+            values = mask
+            while values:
+                positions[base + lowest_bit[values]] &= ~bit
+                values &= values - 1
+
+    def get(self, unit, value):
+        '''Positions of the unit (bit i for the i-th cell) where value can still go'''
+        return self.positions[unit * self.size + value]
+
+
+class Trail:
+    '''Undo stack of the bitmask backend, shared by the assignments and the domain prunings.
+    Every entry is a flat index and the domain mask it had before the change, assignments are stored
+    with the index as ~idx. The entries live in two lists allocated once, so making a change and
+    undoing it back to a checkpoint (the value of top) do not allocate anything.
+    Along one branch every cell is assigned at most once and every value is removed at most once,
+    so num_cells * (size + 1) entries are always enough.
+    '''
+
+    def __init__(self, sudoku, **kwargs):
+        self.sudoku = sudoku
+        self.domains = kwargs['domains']
+        self.row_used, self.col_used, self.box_used = kwargs['row_used'], kwargs['col_used'], kwargs['box_used']
+        self.geometry = kwargs.get('geometry', GEOMETRY)
+        self.mrv_index = kwargs.get('mrv_index')
+        self.position_index = kwargs.get('position_index')
+        capacity = self.geometry.num_cells * (self.geometry.size + 1)
+        self.cells = [0] * capacity
+        self.masks = [0] * capacity
+        self.top = 0
+
+    def remove(self, idx, mask):
+        '''Remove the values in mask from the domain of the flat index idx, they must be in it'''
+        self.cells[self.top] = idx
+        self.masks[self.top] = self.domains[idx]
+        self.top += 1
+        self.domains[idx] &= ~mask
+        if self.position_index is not None:
+            self.position_index.remove(idx, mask)
+
+    def assign(self, idx, val):
+        '''Place val at the flat index idx and narrow its domain to it'''
+        geometry = self.geometry
+        bit = 1 << val
+        self.cells[self.top] = ~idx
+        self.masks[self.top] = self.domains[idx]
+        self.top += 1
+        self.sudoku[geometry.cell_row[idx]][geometry.cell_col[idx]] = val
+        self.row_used[geometry.cell_row[idx]] |= bit
+        self.col_used[geometry.cell_col[idx]] |= bit
+        self.box_used[geometry.cell_box[idx]] |= bit
+        if self.position_index is not None:
+            self.position_index.remove(idx, self.domains[idx] & ~bit)
+        self.domains[idx] = bit
+        if self.mrv_index is not None:
+            self.mrv_index.assign(idx)
+
+    def undo_to(self, checkpoint):
+        '''Undo the entries after the checkpoint, the most recent first'''
+        geometry, domains, mrv_index = self.geometry, self.domains, self.mrv_index
+        position_index = self.position_index
+        while self.top > checkpoint:
+            self.top -= 1
+            idx = self.cells[self.top]
+            if idx < 0:
+                idx = ~idx
+                row, col = geometry.cell_row[idx], geometry.cell_col[idx]
+                bit = ~(1 << self.sudoku[row][col])
+                self.sudoku[row][col] = -1
+                self.row_used[row] &= bit
+                self.col_used[col] &= bit
+                self.box_used[geometry.cell_box[idx]] &= bit
+                if position_index is not None:
+                    position_index.add(idx, self.masks[self.top] & ~domains[idx])
+                domains[idx] = self.masks[self.top]
+                if mrv_index is not None:
+                    mrv_index.unassign(idx)
+            else:
+                if position_index is not None:
+                    position_index.add(idx, self.masks[self.top] & ~domains[idx])
+                domains[idx] = self.masks[self.top]
+                if mrv_index is not None:
+                    mrv_index.refresh(idx)
+
+
+class SolveStats:
+    '''Counters and event hooks of a solve, passed to the solve_* functions as stats (None, the default,
+    turns the instrumentation off and costs a few None checks per node).
+        waterfalls: dict waterfall name -> {'calls', 'time', 'prunings', 'wasted'}, the number of calls,
+                    their cumulative time in seconds, the number of values they removed and the number
+                    of calls that removed nothing
+        nodes: number of search nodes entered
+        depth, max_depth: the current and the deepest number of guessed values on the branch
+        backtracks: number of guessed values undone
+        contradictions: number of times a waterfall emptied a domain or a cell had no value left
+        mrv_calls, mrv_time: calls to get_mrv_position and their cumulative time in seconds
+        backjumps: number of nodes BackjumpSearch left with values not tried yet
+        nogood_prunings: number of values BackjumpSearch skipped because of a cached nogood
+    The hooks are called as on_assign(x, y, val, depth), on_backtrack(x, y, val, depth) when the guess val
+    failed, on_prune(x, y, values, source) with the list of values a waterfall removed from (x, y), and
+    on_contradiction(source, depth); source is the waterfall name, or 'search' for a cell without values.
+    '''
+
+    def __init__(self, on_assign=None, on_backtrack=None, on_prune=None, on_contradiction=None):
+        self.on_assign = on_assign
+        self.on_backtrack = on_backtrack
+        self.on_prune = on_prune
+        self.on_contradiction = on_contradiction
+        self.waterfalls = {}
+        self.nodes = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.backtracks = 0
+        self.contradictions = 0
+        self.mrv_calls = 0
+        self.mrv_time = 0.0
+        self.backjumps = 0
+        self.nogood_prunings = 0
+
+    def assign(self, x, y, val):
+        self.depth += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        if self.on_assign is not None:
+            self.on_assign(x, y, val, self.depth)
+
+    def backtrack(self, x, y, val):
+        self.depth -= 1
+        self.backtracks += 1
+        if self.on_backtrack is not None:
+            self.on_backtrack(x, y, val, self.depth)
+
+    def contradiction(self, source):
+        self.contradictions += 1
+        if self.on_contradiction is not None:
+            self.on_contradiction(source, self.depth)
+
+    def waterfall(self, name, elapsed, prunings):
+        '''Record one call of the waterfall name'''
+        if name not in self.waterfalls:
+            self.waterfalls[name] = {'calls': 0, 'time': 0.0, 'prunings': 0, 'wasted': 0}
+        counters = self.waterfalls[name]
+        counters['calls'] += 1
+        counters['time'] += elapsed
+        counters['prunings'] += prunings
+        if prunings == 0:
+            counters['wasted'] += 1
+
+    def prune_set(self, changes, source):
+        '''Count the changes of a set backend waterfall, [cell, value] pairs, and call on_prune'''
+        if self.on_prune is not None:
+            removed = {}
+            for cell, value in changes:
+                removed.setdefault(cell, []).append(value)
+            for (x, y), values in removed.items():
+                self.on_prune(x, y, values, source)
+        return len(changes)
+
+    def prune_trail(self, trail, start, source):
+        '''Count the values removed by the trail entries from start to the top, and call on_prune'''
+        domains, geometry = trail.domains, trail.geometry
+        removed = {}
+        # The domain every entry changed to is the mask of the next entry of the cell, or its current domain
+        after = {}
+        for i in range(trail.top - 1, start - 1, -1):
+            idx = trail.cells[i]
+            mask = trail.masks[i] & ~after.get(idx, domains[idx])
+            after[idx] = trail.masks[i]
+            removed[idx] = removed.get(idx, 0) | mask
+        prunings = 0
+        for idx, mask in removed.items():
+            prunings += geometry.popcount[mask]
+            if self.on_prune is not None:
+                values = [value for value in range(geometry.size) if (mask >> value) & 1]
+                self.on_prune(geometry.cell_row[idx], geometry.cell_col[idx], values, source)
+        return prunings
+
+    def add(self, other):
+        '''Add the counters of other to these ones, to aggregate the stats of several solves'''
+        for name, counters in other.waterfalls.items():
+            if name not in self.waterfalls:
+                self.waterfalls[name] = {'calls': 0, 'time': 0.0, 'prunings': 0, 'wasted': 0}
+            for key, value in counters.items():
+                self.waterfalls[name][key] += value
+        self.nodes += other.nodes
+        self.max_depth = max(self.max_depth, other.max_depth)
+        self.backtracks += other.backtracks
+        self.contradictions += other.contradictions
+        self.mrv_calls += other.mrv_calls
+        self.mrv_time += other.mrv_time
+        self.backjumps += other.backjumps
+        self.nogood_prunings += other.nogood_prunings
+
+    def as_dict(self):
+        '''The counters as a dict that can be dumped as JSON'''
+        return {
+            'waterfalls': {name: dict(counters) for name, counters in self.waterfalls.items()},
+            'nodes': self.nodes,
+            'max_depth': self.max_depth,
+            'backtracks': self.backtracks,
+            'contradictions': self.contradictions,
+            'mrv_calls': self.mrv_calls,
+            'mrv_time': self.mrv_time,
+            'backjumps': self.backjumps,
+            'nogood_prunings': self.nogood_prunings,
+        }
+
 
 def undo_waterfall_changes(sudoku, changes, **kwargs):
     ''' Undo the changes made by the waterfalls
         input: sudoku: the sudoku to be solved
                changes: list of changes made by the waterfalls previously
+                        (for the bitmask backend, the trail checkpoint returned by apply_waterfall_methods)
                kwargs: other keyword arguments
         output: None
 
     '''
     domains = kwargs['domains']
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        kwargs['trail'].undo_to(changes)
+        return
     for lst in changes:
         var_removed = lst[0]
         val_removed = lst[1]
@@ -134,20 +667,41 @@ def apply_waterfall_methods(sudoku, list_of_waterfalls, **kwargs):
                list_of_waterfalls: list of waterfall methods
                kwargs: other keyword arguments
         output: isPoss: True if the sudoku is solved, False otherwise
-                all_changes: list of changes made by the waterfalls'''
+                all_changes: list of changes made by the waterfalls
+                             (for the bitmask backend, the trail checkpoint to undo them)'''
+    if kwargs.get('scheduler') is not None:
+        return kwargs['scheduler'].apply(sudoku, **kwargs)
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return apply_waterfall_methods_bitmask(sudoku, list_of_waterfalls, **kwargs)
     all_changes = []
+    # Cells changed since the last ac3_waterfall call, None when AC-3 rechecks every arc
+    dirty = kwargs.get('ac3_dirty')
+    stats = kwargs.get('stats')
     #Keep applying the waterfalls until no change is made
     while True:
         #Flag to check if any change is made by the waterfalls
         any_chage = False
         for waterfall in list_of_waterfalls:
+            if stats is not None:
+                start = time.perf_counter()
             isPoss, changes = waterfall(sudoku, **kwargs)
+            if stats is not None:
+                elapsed = time.perf_counter() - start
+                stats.waterfall(waterfall.__name__, elapsed, stats.prune_set(changes, waterfall.__name__))
             all_changes += changes
             # If any change is made, then set the flag to True
             if len(changes) > 0:
                 any_chage = True
+                if dirty is not None and waterfall is not ac3_waterfall:
+                    for cell, _ in changes:
+                        dirty.add(cell)
             # If the sudoku is not possible fill up, then return False and the changes made to be undone
             if not isPoss:
+                # The caller undoes everything back to the last consistent state, nothing is left to propagate
+                if dirty is not None:
+                    dirty.clear()
+                if stats is not None:
+                    stats.contradiction(waterfall.__name__)
                 return False, all_changes
         # If no change is made by the waterfalls at current iteration, then break
         if not any_chage:
@@ -155,6 +709,149 @@ def apply_waterfall_methods(sudoku, list_of_waterfalls, **kwargs):
     return True, all_changes
 
 
+def apply_waterfall_methods_bitmask(sudoku, list_of_waterfalls, **kwargs):
+    ''' Apply the waterfall methods to the sudoku with the bitmask backend, the waterfalls push their
+        changes on kwargs['trail'] and return how many they pushed
+        input: sudoku: the sudoku to be solved
+               list_of_waterfalls: list of waterfall methods
+               kwargs: other keyword arguments
+        output: isPoss: True if the sudoku is solved, False otherwise
+                checkpoint: the trail checkpoint to pass to undo_waterfall_changes'''
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    dirty = kwargs.get('ac3_dirty')
+    mrv_index = kwargs.get('mrv_index')
+    stats = kwargs.get('stats')
+    while True:
+        any_change = False
+        for waterfall in list_of_waterfalls:
+            before = trail.top
+            if stats is not None:
+                start = time.perf_counter()
+            isPoss, changes = waterfall(sudoku, **kwargs)
+            if stats is not None:
+                elapsed = time.perf_counter() - start
+                stats.waterfall(waterfall.__name__, elapsed, stats.prune_trail(trail, before, waterfall.__name__))
+            if changes > 0:
+                any_change = True
+                for i in range(before, trail.top):
+                    if dirty is not None and waterfall is not ac3_waterfall:
+                        dirty.add(trail.cells[i])
+                    if mrv_index is not None:
+                        mrv_index.refresh(trail.cells[i])
+            if not isPoss:
+                if dirty is not None:
+                    dirty.clear()
+                if stats is not None:
+                    stats.contradiction(waterfall.__name__)
+                return False, checkpoint
+        if not any_change:
+            break
+    return True, checkpoint
+
+
+class WaterfallScheduler:
+    '''Replaces the fixed order loop of apply_waterfall_methods when it is passed as kwargs['scheduler'].
+    The waterfalls run from the best to the worst yield per unit of cost, and the loop starts again from
+    the best one after every change, so the expensive waterfalls only run when the cheap ones stall.
+    A waterfall is not rerun while nothing changed since it last found nothing, and the loop ends when
+    every waterfall found nothing, so the waterfalls reach the same kind of fixpoint as the fixed loop.
+    The yield of a waterfall is learned during the solve (changes per call), its cost is a fixed weight
+    from costs (WATERFALL_COSTS by default), so the order and the guesses do not depend on the timings.
+        list_of_waterfalls: the waterfalls to schedule
+        patience: after this many calls in a row that found nothing a waterfall is skipped at the next
+                  1, 2, 4, ... nodes until it finds something again; None never skips (skipping saves
+                  time but can cost guesses)
+    '''
+
+    def __init__(self, list_of_waterfalls, costs=None, patience=None):
+        self.waterfalls = list(list_of_waterfalls)
+        if costs is None:
+            costs = WATERFALL_COSTS
+        self.costs = [costs.get(waterfall, 1.0) for waterfall in self.waterfalls]
+        self.patience = patience
+        self.calls = [0] * len(self.waterfalls)
+        self.changes = [0] * len(self.waterfalls)
+        # Calls in a row that found nothing, and the node before which the waterfall is skipped
+        self.wasted = [0] * len(self.waterfalls)
+        self.skip_until = [0] * len(self.waterfalls)
+        self.nodes = 0
+
+    def order(self):
+        '''Indices of the waterfalls from the best to the worst yield per unit of cost'''
+        return sorted(range(len(self.waterfalls)), key=lambda i: (
+            -(self.changes[i] + 1) / ((self.calls[i] + 1) * self.costs[i]), i))
+
+    def record(self, i, changes):
+        '''Learn from a call of the i-th waterfall that made changes'''
+        self.calls[i] += 1
+        self.changes[i] += changes
+        if changes:
+            self.wasted[i] = 0
+            return
+        self.wasted[i] += 1
+        if self.patience is not None and self.wasted[i] >= self.patience:
+            self.skip_until[i] = self.nodes + (1 << min(self.wasted[i] - self.patience, 10))
+
+    def apply(self, sudoku, **kwargs):
+        '''Same as apply_waterfall_methods with the waterfalls of the scheduler'''
+        bitmask = kwargs.get('backend') == BITMASK_BACKEND
+        trail = kwargs.get('trail')
+        checkpoint = trail.top if bitmask else None
+        all_changes = []
+        dirty = kwargs.get('ac3_dirty')
+        mrv_index = kwargs.get('mrv_index')
+        stats = kwargs.get('stats')
+        self.nodes += 1
+        order = [i for i in self.order() if self.skip_until[i] <= self.nodes]
+        # The waterfalls that found nothing since the last change
+        clean = set()
+        pos = 0
+        while pos < len(order):
+            i = order[pos]
+            if i in clean:
+                pos += 1
+                continue
+            waterfall = self.waterfalls[i]
+            before = trail.top if bitmask else None
+            if stats is not None:
+                start = time.perf_counter()
+            isPoss, changes = waterfall(sudoku, **kwargs)
+            if stats is not None:
+                elapsed = time.perf_counter() - start
+                if bitmask:
+                    stats.waterfall(waterfall.__name__, elapsed, stats.prune_trail(trail, before, waterfall.__name__))
+                else:
+                    stats.waterfall(waterfall.__name__, elapsed, stats.prune_set(changes, waterfall.__name__))
+            if bitmask:
+                for j in range(before, trail.top):
+                    if dirty is not None and waterfall is not ac3_waterfall:
+                        dirty.add(trail.cells[j])
+                    if mrv_index is not None:
+                        mrv_index.refresh(trail.cells[j])
+            else:
+                all_changes += changes
+                if dirty is not None and waterfall is not ac3_waterfall:
+                    for cell, _ in changes:
+                        dirty.add(cell)
+            count = changes if bitmask else len(changes)
+            self.record(i, count)
+            if not isPoss:
+                if dirty is not None:
+                    dirty.clear()
+                if stats is not None:
+                    stats.contradiction(waterfall.__name__)
+                return False, checkpoint if bitmask else all_changes
+            if count:
+                # AC-3 runs to its own fixpoint, rerunning it right away would find nothing
+                clean = {i} if waterfall is ac3_waterfall else set()
+                pos = 0
+            else:
+                clean.add(i)
+                pos += 1
+        return True, checkpoint if bitmask else all_changes
+
+
 def get_next_position_to_fill(sudoku, x, y, mrv_on, **kwargs):
     ''' Get the next position to fill during the backtracking
         input: sudoku: the sudoku to be solved
@@ -165,10 +862,17 @@ def get_next_position_to_fill(sudoku, x, y, mrv_on, **kwargs):
         output: nx: next row number
                 ny: next column number'''
     if mrv_on:
+        if kwargs.get('stats') is not None:
+            stats = kwargs['stats']
+            start = time.perf_counter()
+            position = get_mrv_position(sudoku, **kwargs)
+            stats.mrv_calls += 1
+            stats.mrv_time += time.perf_counter() - start
+            return position
         return get_mrv_position(sudoku, **kwargs)
     else:
-        for row in range(0, 9):
-            for col in range(0, 9):
+        for row in range(0, len(sudoku)):
+            for col in range(0, len(sudoku)):
                 if sudoku[row][col] == -1:
                     return (row, col)
         return -1, -1
@@ -187,6 +891,9 @@ def solve_sudoku(sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs):
                         guess: number of guesses made'''
     
     #Feel free to change the function as you need, for example, you can change the keyword arguments in the function calls below
+    stats = kwargs.get('stats')
+    if stats is not None:
+        stats.nodes += 1
     #First you need to check whether the sudoku is solved or not
     if isSolved(sudoku):
         return True, sudoku, 0
@@ -217,18 +924,26 @@ def solve_sudoku(sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs):
 
     no_cur_guess = 0
     #Check how many guesses are possible for the current position
-    for i in range(9):
-        if isPossible(sudoku, x, y, i, **kwargs):
-            no_cur_guess += 1
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        no_cur_guess = kwargs['geometry'].popcount[get_candidates_bitmask(x, y, **kwargs)]
+    else:
+        for i in range(len(sudoku)):
+            if isPossible(sudoku, x, y, i, **kwargs):
+                no_cur_guess += 1
         
     if no_cur_guess == 0:
+        if stats is not None:
+            stats.contradiction('search')
+        undo_waterfall_changes(sudoku, changes, **kwargs)
         return False, sudoku, 0
 
-    for i in range(9):
+    for i in range(len(sudoku)):
         #Check if the value is possible at the current position
         if isPossible(sudoku, x, y, i, **kwargs):
             #If the value is possible, then update the changes for the current position
             update_changes_for_position(sudoku, x, y, i, **kwargs)
+            if stats is not None:
+                stats.assign(x, y, i)
             #Get the next position to fill
             nx, ny = get_next_position_to_fill(sudoku, x, y, mrv_on, **kwargs)
             #Solve the sudoku for the next position
@@ -240,42 +955,677 @@ def solve_sudoku(sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs):
                 return True, sudoku, no_cur_guess -1
             else:
                 undo_changes_for_position(sudoku, x, y, i, **kwargs)
+                if stats is not None:
+                    stats.backtrack(x, y, i)
     
     #If the sudoku cannot solved at current partially filled state, then undo the changes made by the waterfalls and return False
     undo_waterfall_changes(sudoku, changes, **kwargs)
     return False, sudoku, no_cur_guess - 1
 
 
+class SearchState:
+    '''Non recursive version of solve_sudoku for the bitmask backend, the search tree is kept on an
+    explicit stack so the search can stop when a budget runs out and continue later from the same place.
+    It makes the same choices and counts the guesses the same way as solve_sudoku.
+    Every stack frame is [idx, checkpoint, guesses, last_value]: the flat index of the cell of the node,
+    the trail checkpoint from before its waterfalls, the guesses counted at the node so far and the last
+    value tried at it (last_value is None for a node whose cell was already filled).
+        nodes: the number of nodes entered so far, over every call to run
+        finished: whether the search has ended, run only returns the result again after that
+    '''
+
+    def __init__(self, sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs):
+        self.sudoku = sudoku
+        self.mrv_on = mrv_on
+        self.list_of_waterfalls = list_of_waterfalls
+        self.kwargs = kwargs
+        self.geometry = kwargs.get('geometry', GEOMETRY)
+        self.trail = kwargs['trail']
+        self.stats = kwargs.get('stats')
+        self.stack = []
+        # Flat index of the node to enter next, None while a result goes up the stack
+        self.position = self.to_index(x, y)
+        # (solved, guesses) of the last node that returned
+        self.result = None
+        self.empty = sum(row.count(-1) for row in sudoku)
+        self.nodes = 0
+        self.finished = False
+
+    def to_index(self, x, y):
+        '''Flat index of (x, y), with the negative indices of get_mrv_position when no cell is found'''
+        size = self.geometry.size
+        return (x % size) * size + y % size
+
+    def next_position(self):
+        '''The cell of the next node, select_position timed for the stats when mrv is on'''
+        if self.mrv_on and self.stats is not None:
+            start = time.perf_counter()
+            idx = self.select_position()
+            self.stats.mrv_calls += 1
+            self.stats.mrv_time += time.perf_counter() - start
+            return idx
+        return self.select_position()
+
+    def select_position(self):
+        '''Same choice as get_next_position_to_fill'''
+        if self.mrv_on:
+            if self.kwargs.get('mrv_index') is not None:
+                idx = self.kwargs['mrv_index'].select()
+                return self.to_index(-1, -1) if idx < 0 else idx
+            return self.to_index(*get_mrv_position_bitmask(self.sudoku, **self.kwargs))
+        for idx in range(self.geometry.num_cells):
+            if self.sudoku[self.geometry.cell_row[idx]][self.geometry.cell_col[idx]] == -1:
+                return idx
+        return self.to_index(-1, -1)
+
+    def candidates(self, idx):
+        '''Same values as isPossible for the flat index idx'''
+        geometry, kwargs = self.geometry, self.kwargs
+        used = kwargs['row_used'][geometry.cell_row[idx]] | kwargs['col_used'][geometry.cell_col[idx]] | \
+            kwargs['box_used'][geometry.cell_box[idx]]
+        return kwargs['domains'][idx] & ~used
+
+    def try_next_value(self, frame):
+        '''Assign the next possible value at the node of frame and enter its child, False if none is left'''
+        idx, last_value = frame[0], frame[3]
+        remaining = self.candidates(idx) & ~((1 << (last_value + 1)) - 1)
+        if remaining == 0:
+            return False
+        frame[3] = self.geometry.lowest_bit[remaining]
+        self.trail.assign(idx, frame[3])
+        self.empty -= 1
+        if self.stats is not None:
+            self.stats.assign(self.geometry.cell_row[idx], self.geometry.cell_col[idx], frame[3])
+        if self.kwargs.get('ac3_dirty') is not None:
+            self.kwargs['ac3_dirty'].add(idx)
+        self.position = self.next_position()
+        return True
+
+    def enter(self):
+        '''Enter the node at self.position, either push a frame for it or set self.result'''
+        idx = self.position
+        self.position = None
+        self.nodes += 1
+        if self.stats is not None:
+            self.stats.nodes += 1
+        if self.empty == 0:
+            self.result = (True, 0)
+            return
+        checkpoint = self.trail.top
+        if self.list_of_waterfalls:
+            isPoss, checkpoint = apply_waterfall_methods(self.sudoku, self.list_of_waterfalls, **self.kwargs)
+            if not isPoss:
+                self.trail.undo_to(checkpoint)
+                self.result = (False, 0)
+                return
+        if self.sudoku[self.geometry.cell_row[idx]][self.geometry.cell_col[idx]] != -1:
+            self.stack.append([idx, checkpoint, 0, None])
+            self.position = self.next_position()
+            return
+        no_cur_guess = self.geometry.popcount[self.candidates(idx)]
+        if no_cur_guess == 0:
+            if self.stats is not None:
+                self.stats.contradiction('search')
+            self.trail.undo_to(checkpoint)
+            self.result = (False, 0)
+            return
+        frame = [idx, checkpoint, no_cur_guess, -1]
+        self.stack.append(frame)
+        self.try_next_value(frame)
+
+    def backtrack(self):
+        '''Hand self.result to the node on top of the stack'''
+        solved, guesses = self.result
+        frame = self.stack[-1]
+        if frame[3] is None:
+            self.stack.pop()
+            if not solved:
+                self.trail.undo_to(frame[1])
+            return
+        frame[2] += guesses
+        if solved:
+            self.stack.pop()
+            self.result = (True, frame[2] - 1)
+            return
+        # Undo the assignment of the value that failed
+        self.trail.undo_to(self.trail.top - 1)
+        self.empty += 1
+        if self.stats is not None:
+            self.stats.backtrack(self.geometry.cell_row[frame[0]], self.geometry.cell_col[frame[0]], frame[3])
+        if self.try_next_value(frame):
+            self.result = None
+            return
+        self.stack.pop()
+        self.trail.undo_to(frame[1])
+        self.result = (False, frame[2] - 1)
+
+    def solutions(self):
+        '''Continue the search past every solution, yielding a copy of each one as it is found;
+        the search stops where it is when the caller stops iterating'''
+        while not self.finished:
+            if self.position is not None:
+                self.enter()
+                if self.result is not None and self.result[0]:
+                    yield [row[:] for row in self.sudoku]
+                    # Go on as if the solution was a dead end
+                    self.result = (False, 0)
+            elif self.stack:
+                self.backtrack()
+            else:
+                self.finished = True
+
+    def split(self):
+        '''Stop the search and get the work it has left as subproblems (see solve_parallel): the node it
+        was about to enter, then every value not tried yet at every node on the stack'''
+        subproblems = []
+        if self.position is not None:
+            subproblems.append(([row[:] for row in self.sudoku], list(self.kwargs['domains'])))
+        trail = self.trail
+        for frame in reversed(self.stack):
+            idx, last_value = frame[0], frame[3]
+            if last_value is None:
+                continue
+            # Go back to the node before it assigned last_value, the assignment is the entry ~idx
+            entry = trail.top - 1
+            while trail.cells[entry] != ~idx:
+                entry -= 1
+            trail.undo_to(entry)
+            remaining = self.candidates(idx) & ~((1 << (last_value + 1)) - 1)
+            while remaining:
+                trail.assign(idx, self.geometry.lowest_bit[remaining])
+                subproblems.append(([row[:] for row in self.sudoku], list(self.kwargs['domains'])))
+                trail.undo_to(trail.top - 1)
+                remaining &= remaining - 1
+        self.result = (None, self.guesses_so_far())
+        self.stack = []
+        self.position = None
+        self.finished = True
+        return subproblems
+
+    def guesses_so_far(self):
+        '''The guesses counted by the nodes on the stack, what a failure of the current node would return'''
+        return sum(frame[2] - 1 for frame in self.stack if frame[3] is not None)
+
+    def run(self, node_budget=None, deadline=None):
+        '''Continue the search
+        input:  node_budget: the maximum number of nodes to enter during this call, None for no limit
+                deadline: the time.monotonic() value after which the search stops, None for no limit
+        output: solved: True if solved, False if there is no solution, None if a budget ran out
+                sudoku: the solved sudoku (the state itself when a budget ran out)
+                guesses: number of guesses made (so far when a budget ran out)'''
+        nodes_at_start = self.nodes
+        while not self.finished:
+            if self.position is not None:
+                if node_budget is not None and self.nodes - nodes_at_start >= node_budget:
+                    return None, self, self.guesses_so_far()
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None, self, self.guesses_so_far()
+                self.enter()
+            elif self.stack:
+                self.backtrack()
+            else:
+                self.finished = True
+        return self.result[0], self.sudoku, self.result[1]
+
+
+# Number of nogoods a NogoodCache keeps, and the longest nogood it keeps
+NOGOOD_CACHE_SIZE = 4096
+NOGOOD_MAX_LENGTH = 12
+
+
+class NogoodCache:
+    '''Bounded cache of the nogoods learned by BackjumpSearch: sets of decisions that cannot all hold in a
+    solution, every decision a literal idx * size + value. Once it is full the least recently used nogood
+    is evicted.
+        max_size: the number of nogoods kept
+        max_length: longer nogoods are not kept, they seldom hold again
+        learned, evicted: the number of nogoods added and evicted so far
+    '''
+
+    def __init__(self, max_size=NOGOOD_CACHE_SIZE, max_length=NOGOOD_MAX_LENGTH):
+        self.max_size = max_size
+        self.max_length = max_length
+        # nogood (sorted tuple of literals) -> None, the least recently used first
+        self.entries = OrderedDict()
+        # literal -> the set of nogoods it is part of
+        self.watches = {}
+        self.learned = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, literals):
+        '''Add the nogood made of literals'''
+        if not literals or len(literals) > self.max_length:
+            return
+        nogood = tuple(sorted(literals))
+        if nogood in self.entries:
+            self.entries.move_to_end(nogood)
+            return
+        self.entries[nogood] = None
+        for literal in nogood:
+            self.watches.setdefault(literal, set()).add(nogood)
+        self.learned += 1
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            for literal in evicted:
+                watching = self.watches[literal]
+                watching.discard(evicted)
+                if not watching:
+                    del self.watches[literal]
+            self.evicted += 1
+
+    def get(self, literal):
+        '''The nogoods literal is part of, None if there are none'''
+        return self.watches.get(literal)
+
+    def touch(self, nogood):
+        '''Mark the nogood as used, it is evicted last'''
+        self.entries.move_to_end(nogood)
+
+
+class BackjumpSearch(SearchState):
+    '''SearchState with conflict-directed backjumping and nogood learning, used when the kwargs have a
+    NogoodCache as nogoods (see get_initial_kwargs). Its waterfalls record why every value was removed:
+    the conflict set of the removal, a mask with bit l set for every stack level l whose guess it depends on
+    (the givens are in no level). When a node fails, its conflict set is handed up the stack; a node whose
+    guess is not in it has nothing to retry and is left at once, the others add it to their own conflict set
+    and try their next value. A node without values left hands up the conflict sets of all its values and
+    caches their guesses as a nogood, which rules the value out whenever the other guesses of the nogood hold.
+    Only the waterfalls it can explain are run: ac3_waterfall and naked_single_waterfall (a value of a
+    single-valued cell is removed from its peers) and hidden_single_waterfall.
+    Every stack frame has a fifth item, the conflict set of the values that failed at the node.
+    '''
+
+    def __init__(self, sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs):
+        unknown = [waterfall.__name__ for waterfall in list_of_waterfalls
+                   if waterfall not in (ac3_waterfall, naked_single_waterfall, hidden_single_waterfall)]
+        if unknown:
+            raise ValueError('Backjumping cannot explain the prunings of ' + ', '.join(unknown))
+        super().__init__(sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs)
+        self.naked_singles = ac3_waterfall in list_of_waterfalls or naked_single_waterfall in list_of_waterfalls
+        self.hidden_singles = hidden_single_waterfall in list_of_waterfalls
+        self.nogoods = kwargs['nogoods']
+        geometry = self.geometry
+        # reasons[idx * size + value]: the conflict set of the removal of value from the domain of idx,
+        # only meaningful while the value is removed
+        self.reasons = [0] * (geometry.num_cells * geometry.size)
+        # The level bit of the guess of every cell filled by the search, 0 for the givens
+        self.cell_level = [0] * geometry.num_cells
+        # The conflict set of the last failure, None for every level on the stack
+        self.conflict = None
+        # Cells with a single value left whose value was not removed from their peers yet
+        domains = kwargs['domains']
+        self.pending = [idx for idx in range(geometry.num_cells)
+                        if domains[idx] and domains[idx] & (domains[idx] - 1) == 0]
+
+    def remove(self, idx, mask, reason):
+        '''Remove the values in mask from the domain of idx because of the conflict set reason'''
+        base, lowest_bit, reasons = idx * self.geometry.size, self.geometry.lowest_bit, self.reasons
+        values = mask
+        while values:
+            reasons[base + lowest_bit[values]] = reason
+            values &= values - 1
+        self.trail.remove(idx, mask)
+        # Keep the MRV buckets in step with the pruned domain
+        if self.kwargs.get('mrv_index') is not None:
+            self.kwargs['mrv_index'].refresh(idx)
+        domain = self.kwargs['domains'][idx]
+        if domain and domain & (domain - 1) == 0:
+            self.pending.append(idx)
+
+    def explain_domain(self, idx):
+        '''The conflict set of the values missing from the domain of idx'''
+        geometry, domains = self.geometry, self.kwargs['domains']
+        value = self.sudoku[geometry.cell_row[idx]][geometry.cell_col[idx]]
+        if value != -1:
+            # The guess removed every other value
+            conflict = self.cell_level[idx]
+            removed = (1 << value) & ~domains[idx]
+        else:
+            conflict = 0
+            removed = geometry.all_values & ~domains[idx]
+        base, lowest_bit, reasons = idx * geometry.size, geometry.lowest_bit, self.reasons
+        while removed:
+            conflict |= reasons[base + lowest_bit[removed]]
+            removed &= removed - 1
+        return conflict
+
+    def explain_values(self, idx):
+        '''The conflict set of the values missing from the candidates of the empty cell idx'''
+        geometry, sudoku = self.geometry, self.sudoku
+        cell_row, cell_col = geometry.cell_row, geometry.cell_col
+        domain = self.kwargs['domains'][idx]
+        missing = geometry.all_values & ~self.candidates(idx)
+        base, lowest_bit = idx * geometry.size, geometry.lowest_bit
+        conflict = 0
+        while missing:
+            value = lowest_bit[missing]
+            missing &= missing - 1
+            if domain >> value & 1:
+                # Still in the domain, a peer holds it
+                for peer in geometry.peer_indices[idx]:
+                    if sudoku[cell_row[peer]][cell_col[peer]] == value:
+                        conflict |= self.cell_level[peer]
+                        break
+            else:
+                conflict |= self.reasons[base + value]
+        return conflict
+
+    def explain_unit(self, unit, value, skip=-1):
+        '''The conflict set of value missing from the cells of unit, except skip'''
+        geometry, sudoku, reasons = self.geometry, self.sudoku, self.reasons
+        cell_row, cell_col, size = geometry.cell_row, geometry.cell_col, geometry.size
+        conflict = 0
+        for idx in unit:
+            if idx == skip:
+                continue
+            if sudoku[cell_row[idx]][cell_col[idx]] != -1:
+                conflict |= self.cell_level[idx]
+            else:
+                conflict |= reasons[idx * size + value]
+        return conflict
+
+    def propagate(self):
+        '''Run the waterfalls until nothing changes, get None or the conflict set of a contradiction'''
+        domains, pending, peer_indices = self.kwargs['domains'], self.pending, self.geometry.peer_indices
+        while True:
+            if not self.naked_singles:
+                pending.clear()
+            while pending:
+                cell = pending.pop()
+                mask = domains[cell]
+                reason = None
+                for peer in peer_indices[cell]:
+                    if domains[peer] & mask:
+                        if reason is None:
+                            reason = self.explain_domain(cell)
+                        self.remove(peer, mask, reason)
+                        if domains[peer] == 0:
+                            pending.clear()
+                            return self.explain_domain(peer)
+            if not self.hidden_singles:
+                return None
+            top = self.trail.top
+            conflict = self.propagate_hidden_singles()
+            if conflict is not None:
+                pending.clear()
+                return conflict
+            if self.trail.top == top:
+                return None
+
+    def propagate_hidden_singles(self):
+        '''hidden_single_waterfall with conflict sets, get None or the conflict set of a contradiction'''
+        geometry, domains = self.geometry, self.kwargs['domains']
+        lowest_bit, all_values = geometry.lowest_bit, geometry.all_values
+        for unit in geometry.unit_indices:
+            once, twice = 0, 0
+            for idx in unit:
+                twice |= once & domains[idx]
+                once |= domains[idx]
+            if once != all_values:
+                return self.explain_unit(unit, lowest_bit[all_values & ~once])
+            singles = once & ~twice
+            while singles:
+                value = lowest_bit[singles]
+                singles &= singles - 1
+                bit = 1 << value
+                where = -1
+                for idx in unit:
+                    if domains[idx] & bit:
+                        where = idx
+                        break
+                if where == -1:
+                    # Another hidden single of the unit took its only cell
+                    return self.explain_unit(unit, value)
+                if domains[where] != bit:
+                    self.remove(where, domains[where] & ~bit, self.explain_unit(unit, value, where))
+        return None
+
+    def blocking_reason(self, literal):
+        '''The conflict set of a cached nogood with literal whose other guesses all hold, None if there is none'''
+        nogoods = self.nogoods.get(literal)
+        if not nogoods:
+            return None
+        geometry, sudoku = self.geometry, self.sudoku
+        for nogood in nogoods:
+            reason = 0
+            for other in nogood:
+                if other == literal:
+                    continue
+                idx, value = divmod(other, geometry.size)
+                if sudoku[geometry.cell_row[idx]][geometry.cell_col[idx]] != value:
+                    break
+                reason |= self.cell_level[idx]
+            else:
+                self.nogoods.touch(nogood)
+                return reason
+        return None
+
+    def learn(self, conflict):
+        '''Cache the guesses of the levels in conflict as a nogood'''
+        literals = []
+        while conflict:
+            frame = self.stack[(conflict & -conflict).bit_length() - 1]
+            conflict &= conflict - 1
+            literals.append(frame[0] * self.geometry.size + frame[3])
+        self.nogoods.add(literals)
+
+    def try_next_value(self, frame):
+        '''Assign the next possible value that no nogood rules out and enter its child, False if none is left'''
+        idx, size, lowest_bit = frame[0], self.geometry.size, self.geometry.lowest_bit
+        remaining = self.candidates(idx) & ~((1 << (frame[3] + 1)) - 1)
+        while remaining:
+            value = lowest_bit[remaining]
+            reason = self.blocking_reason(idx * size + value)
+            if reason is None:
+                break
+            frame[3] = value
+            frame[4] |= reason
+            remaining &= remaining - 1
+            if self.stats is not None:
+                self.stats.nogood_prunings += 1
+        if remaining == 0:
+            return False
+        frame[3] = value
+        self.cell_level[idx] = 1 << (len(self.stack) - 1)
+        self.trail.assign(idx, value)
+        self.pending.append(idx)
+        self.empty -= 1
+        if self.stats is not None:
+            self.stats.assign(self.geometry.cell_row[idx], self.geometry.cell_col[idx], value)
+        self.position = self.next_position()
+        return True
+
+    def fail(self, checkpoint, guesses, conflict):
+        '''Undo the node back to checkpoint and hand its failure up'''
+        self.trail.undo_to(checkpoint)
+        self.result = (False, guesses)
+        self.conflict = conflict
+
+    def enter(self):
+        '''Enter the node at self.position, either push a frame for it or set self.result'''
+        idx = self.position
+        self.position = None
+        self.nodes += 1
+        if self.stats is not None:
+            self.stats.nodes += 1
+        if self.empty == 0:
+            # Nothing is left to propagate, the search may go on from here to find other solutions
+            self.pending.clear()
+            self.result = (True, 0)
+            self.conflict = None
+            return
+        checkpoint = self.trail.top
+        if self.stats is not None:
+            start = time.perf_counter()
+        conflict = self.propagate()
+        if self.stats is not None:
+            self.stats.waterfall('backjumping', time.perf_counter() - start,
+                                 self.stats.prune_trail(self.trail, checkpoint, 'backjumping'))
+        if conflict is not None:
+            if self.stats is not None:
+                self.stats.contradiction('backjumping')
+            self.fail(checkpoint, 0, conflict)
+            return
+        if self.sudoku[self.geometry.cell_row[idx]][self.geometry.cell_col[idx]] != -1:
+            self.stack.append([idx, checkpoint, 0, None, 0])
+            self.position = self.next_position()
+            return
+        no_cur_guess = self.geometry.popcount[self.candidates(idx)]
+        if no_cur_guess == 0:
+            if self.stats is not None:
+                self.stats.contradiction('search')
+            self.fail(checkpoint, 0, self.explain_values(idx))
+            return
+        frame = [idx, checkpoint, no_cur_guess, -1, 0]
+        self.stack.append(frame)
+        if not self.try_next_value(frame):
+            # Every value is ruled out by a nogood
+            conflict = frame[4] | self.explain_values(idx)
+            self.learn(conflict)
+            self.stack.pop()
+            self.fail(checkpoint, no_cur_guess - 1, conflict)
+
+    def backtrack(self):
+        '''Hand self.result and self.conflict to the node on top of the stack'''
+        solved, guesses = self.result
+        frame = self.stack[-1]
+        if frame[3] is None:
+            self.stack.pop()
+            if not solved:
+                self.trail.undo_to(frame[1])
+            return
+        frame[2] += guesses
+        if solved:
+            self.stack.pop()
+            self.result = (True, frame[2] - 1)
+            return
+        # Undo the assignment of the value that failed
+        self.trail.undo_to(self.trail.top - 1)
+        self.empty += 1
+        if self.stats is not None:
+            self.stats.backtrack(self.geometry.cell_row[frame[0]], self.geometry.cell_col[frame[0]], frame[3])
+        level = 1 << (len(self.stack) - 1)
+        conflict = self.conflict if self.conflict is not None else 2 * level - 1
+        if conflict & level:
+            frame[4] |= conflict & ~level
+            if self.try_next_value(frame):
+                self.result = None
+                return
+            conflict = frame[4] | self.explain_values(frame[0])
+            self.learn(conflict)
+        elif self.stats is not None and self.candidates(frame[0]) & ~((1 << (frame[3] + 1)) - 1):
+            # The failure does not depend on the value of this node, its other values would fail the same way
+            self.stats.backjumps += 1
+        self.stack.pop()
+        self.fail(frame[1], frame[2] - 1, conflict)
+
+
+def solve_sudoku_iterative(sudoku, x, y, mrv_on, list_of_waterfalls, node_budget=None, deadline=None, **kwargs):
+    '''Solve the sudoku like solve_sudoku without recursion, the kwargs must come from
+    get_initial_kwargs with the bitmask backend; with a NogoodCache in them the search is a BackjumpSearch
+        input: same as solve_sudoku
+               node_budget: the maximum number of nodes to enter, None for no limit
+               deadline: the time.monotonic() value after which the search stops, None for no limit
+        output: same as solve_sudoku, except that solved is None when a budget ran out and the second value
+                is then the SearchState; call its run method to continue the search'''
+    search_class = BackjumpSearch if kwargs.get('nogoods') is not None else SearchState
+    return search_class(sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs).run(node_budget, deadline)
+
+
 def ac3_waterfall(sudoku, **kwargs):
     '''The ac3 waterfall method to apply
     input:  sudoku: the sudoku to apply AC-3 method on'
             kwargs: the kwargs to be passed to the isPossible function
     output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
             changes: the changes made to the sudoku'''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return ac3_waterfall_bitmask(sudoku, **kwargs)
     changes = []
     domains = kwargs['domains']
-    arcs = set()
-    for i in range(9):
-            for j in range(9):
-                neighbors = get_neighbors(sudoku,(i, j))
-                for neighbor in neighbors:
-                    arcs.add(((i, j), neighbor))
-    queue = []
-    for arc in arcs:
-        queue.append(arc)
+    peers = kwargs.get('geometry', GEOMETRY).peers
+    dirty = kwargs.get('ac3_dirty')
+    if dirty is None:
+        queue = deque(kwargs.get('geometry', GEOMETRY).arcs)
+    else:
+        # Incremental mode: only the arcs pointing at the cells changed since the last call
+        queue = deque((xk, xj) for xj in dirty for xk in peers[xj])
+        dirty.clear()
+    pending = set(queue)
 
     while queue:
-        (xi, xj) = queue.pop(0)
+        (xi, xj) = queue.popleft()
+        pending.remove((xi, xj))
         revise_bool, changes = revise(domains, xi, xj, changes)
         if revise_bool:
             if len(domains[xi]) == 0:
                 return False, changes
-            for xk in get_neighbors(sudoku,xi) - {xj}:
-                queue.append((xk, xi))
+            for xk in peers[xi] - {xj}:
+                if (xk, xi) not in pending:
+                    pending.add((xk, xi))
+                    queue.append((xk, xi))
     
     kwargs['domains'] = domains
     return True, changes
 
+def ac3_waterfall_bitmask(sudoku, **kwargs):
+    '''The ac3 waterfall method for the bitmask backend, cells are flat indices (row * n + col)
+    input:  sudoku: the sudoku to apply AC-3 method on'
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the number of changes pushed on kwargs['trail']'''
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    domains = kwargs['domains']
+    geometry = kwargs.get('geometry', GEOMETRY)
+    arc_indices, incoming_arcs, popcount = geometry.arc_indices, geometry.incoming_arcs, geometry.popcount
+    dirty = kwargs.get('ac3_dirty')
+    if dirty is None:
+        queue = deque(range(len(arc_indices)))
+        pending = bytearray(b'\x01') * len(arc_indices)
+    else:
+        # Incremental mode: only the arcs pointing at the cells changed since the last call.
+        # revise_bitmask can only remove something along (xk, xj) when xj has a single value,
+        # so the arcs pointing at cells with more values left are not worth queueing.
+        queue = deque()
+        pending = bytearray(len(arc_indices))
+        for xj in dirty:
+            if popcount[domains[xj]] == 1:
+                for arc in incoming_arcs[xj]:
+                    if not pending[arc]:
+                        pending[arc] = 1
+                        queue.append(arc)
+        dirty.clear()
+
+    while queue:
+        arc = queue.popleft()
+        pending[arc] = 0
+        xi, xj = arc_indices[arc]
+        if revise_bitmask(domains, xi, xj, trail):
+            if domains[xi] == 0:
+                return False, trail.top - checkpoint
+            if dirty is None or popcount[domains[xi]] == 1:
+                for arc in incoming_arcs[xi]:
+                    if not pending[arc] and arc_indices[arc][0] != xj:
+                        pending[arc] = 1
+                        queue.append(arc)
+    return True, trail.top - checkpoint
+
+def revise_bitmask(domains, xi, xj, trail):
+    '''Remove the value of xj from the domain of xi if xj has a single value left
+    input:  domains: the flat list of domain masks
+            xi, xj: the flat indices of the arc
+            trail: the Trail the removal is recorded on
+    output: revised: whether the domain of xi was changed'''
+    mask = domains[xj]
+    # mask & (mask - 1) clears the lowest bit, nothing is left when it was the only one
+    if domains[xi] & mask and mask & (mask - 1) == 0:
+        trail.remove(xi, mask)
+        return True
+    return False
+
 def revise(domains, xi, xj, changes):
     revised = False
     to_remove=[]
@@ -289,26 +1639,8 @@ def revise(domains, xi, xj, changes):
     return revised, changes
 
 def get_neighbors(sudoku, cell):
-        neighbors = set()
-        row, col = cell
-        n = len(sudoku)
-
-        #Adding all elemets in same row and same column
-        for i in range(n):
-            neighbors.add((row, i))
-            neighbors.add((i, col))
-
-        #Adding elements in the block
-        sqrt_n = int(np.sqrt(n))
-        row_start = (row // sqrt_n) * sqrt_n
-        col_start = (col // sqrt_n) * sqrt_n
-
-        for i in range(row_start, row_start+sqrt_n):
-            for j in range(col_start, col_start+sqrt_n):
-                neighbors.add((i, j))
-
-        neighbors.remove(cell)
-        return neighbors
+        '''Get the cells sharing a row, column or box with the given cell, shared by all callers; do not modify it'''
+        return get_board_geometry(len(sudoku)).peers[cell]
 
 
 def waterfall1(sudoku, **kwargs):
@@ -317,6 +1649,8 @@ def waterfall1(sudoku, **kwargs):
             kwargs: the kwargs to be passed to the isPossible function
     output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
             changes: the changes made to the sudoku'''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return waterfall1_bitmask(sudoku, **kwargs)
     changes = []
     '''
     We are implementing Hidden Pair Inference, this is the case, where we have a pair of 2 values in the domains of exactly 2
@@ -329,46 +1663,102 @@ def waterfall1(sudoku, **kwargs):
     '''
     #Write your code here
 
-    #Creating sets of all elements in each row, column and a box
-    rows, cols, boxes = [], [], []
-    for i in range(9):
-        rows.append(set([(i, j) for j in range(9)]))
-        cols.append(set([(j, i) for j in range(9)]))
-        boxes.append(set([(i // 3 * 3 + j // 3, i % 3 * 3 + j % 3) for j in range(9)]))
-
     domains = kwargs['domains']
     # Check for hidden pairs in each row, column, and 3x3 box
-
-    for group in [rows, cols, boxes]:
-        for cells in group:
-            pairs = {}
-            for cell in cells:
-                if sudoku[cell[0]][cell[1]] == -1:
-                    for value in domains[(cell[0], cell[1])]:
-                        key = frozenset(digit for digit in domains[cell] if digit != value)
-                        if key not in pairs:
-                            pairs[key] = []
-
-            for key, cells_pair in pairs.items():
-                if len(cells_pair) == 2 and len(key) == 2:
-                    # If there is a hidden pair, remove all other occurrences of those values from the group
-                    for cell in cells:
-                        for other_cell in cells_pair:
-                            if cell==other_cell:
-                                to_be_removed = []
-                                for digit in domains[cell]:
-                                    if digit not in key:
-                                        changes.append([(cell[0], cell[1]), digit])
-                                        to_be_removed.append(digit)
-                                for x in to_be_removed:
-                                        domains[(cell[0],cell[1])].remove(x)
-                                if len(domains[(cell[0],cell[1])]) == 0:
-                                    kwargs['domains'] = domains
-                                    return False, changes
+    for cells in kwargs.get('geometry', GEOMETRY).units:
+        # Values already placed in the unit do not need a position anymore
+        placed = set(sudoku[cell[0]][cell[1]] for cell in cells)
+        positions = {}
+        for cell in cells:
+            if sudoku[cell[0]][cell[1]] == -1:
+                for value in domains[(cell[0], cell[1])]:
+                    if value not in placed:
+                        if value not in positions:
+                            positions[value] = []
+                        positions[value].append(cell)
+
+        # Group the values that can only go to the same 2 positions
+        pairs = {}
+        for value, value_cells in positions.items():
+            if len(value_cells) == 2:
+                key = frozenset(value_cells)
+                if key not in pairs:
+                    pairs[key] = []
+                pairs[key].append(value)
+
+        for cells_pair, key in pairs.items():
+            if len(key) == 2:
+                # If there is a hidden pair, remove all the other values from the domains of the pair
+                for cell in cells_pair:
+                    to_be_removed = []
+                    for digit in domains[cell]:
+                        if digit not in key:
+                            changes.append([(cell[0], cell[1]), digit])
+                            to_be_removed.append(digit)
+                    for x in to_be_removed:
+                            domains[(cell[0],cell[1])].remove(x)
+                    if len(domains[(cell[0],cell[1])]) == 0:
+                        kwargs['domains'] = domains
+                        return False, changes
 
     kwargs['domains'] = domains
     return True, changes
 
+def waterfall1_bitmask(sudoku, **kwargs):
+    '''Hidden Pair Inference (waterfall1) for the bitmask backend
+    input:  sudoku: the sudoku to apply the waterfall method on
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the number of changes pushed on kwargs['trail']'''
+    domains = kwargs['domains']
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    geometry = kwargs.get('geometry', GEOMETRY)
+    cell_row, cell_col = geometry.cell_row, geometry.cell_col
+    popcount, lowest_bit, n = geometry.popcount, geometry.lowest_bit, geometry.size
+    used = kwargs['row_used'] + kwargs['col_used'] + kwargs['box_used']
+    position_index = kwargs.get('position_index')
+
+    for unit_id, (unit, placed) in enumerate(zip(geometry.unit_indices, used)):
+        # Group the values that can only go to the same 2 positions, a position set has bit i set
+        # for the i-th cell of the unit
+        pairs = {}
+        if position_index is not None:
+            # The positions of the values not placed yet are the unassigned cells that have them
+            index_positions, base = position_index.positions, unit_id * n
+            free = geometry.all_values & ~placed
+            while free:
+                value = lowest_bit[free]
+                free &= free - 1
+                where = index_positions[base + value]
+                if popcount[where] == 2:
+                    pairs[where] = pairs.get(where, 0) | (1 << value)
+        else:
+            positions = [0] * n
+            for i, idx in enumerate(unit):
+                if sudoku[cell_row[idx]][cell_col[idx]] == -1:
+                    mask = domains[idx] & ~placed
+                    while mask:
+                        value = lowest_bit[mask]
+                        positions[value] |= 1 << i
+                        mask &= mask - 1
+            for value in range(n):
+                if popcount[positions[value]] == 2:
+                    pairs[positions[value]] = pairs.get(positions[value], 0) | (1 << value)
+
+        for cells_pair, key in pairs.items():
+            if popcount[key] == 2:
+                while cells_pair:
+                    idx = unit[lowest_bit[cells_pair]]
+                    cells_pair &= cells_pair - 1
+                    extra = domains[idx] & ~key
+                    if extra:
+                        trail.remove(idx, extra)
+                        if domains[idx] == 0:
+                            return False, trail.top - checkpoint
+
+    return True, trail.top - checkpoint
+
 def waterfall2(sudoku, **kwargs):
     '''The second waterfall method to apply
     input:  sudoku: the sudoku to apply the waterfall method on
@@ -382,146 +1772,885 @@ def waterfall2(sudoku, **kwargs):
     Therefore we remove those 2 domain values from all the remaining unassigned positions of that unit 
     Implementation given as follows:.
     '''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return waterfall2_bitmask(sudoku, **kwargs)
     domains = kwargs['domains']
     changes = []
     
-    # Creating sets of all elements in each row, column and a box
-    rows, cols, boxes = [], [], []
-    for i in range(9):
-        rows.append(set([(i, j) for j in range(9)]))
-        cols.append(set([(j, i) for j in range(9)]))
-        boxes.append(set([(i // 3 * 3 + j // 3, i % 3 * 3 + j % 3) for j in range(9)]))
-    
     # Check for naked pairs in each row, column, and 3x3 box
-    for group in [rows, cols, boxes]:
-        for cells in group:
-            pairs = {}
-            for cell in cells:
-                if sudoku[cell[0]][cell[1]] == -1:
-                    value = domains[(cell[0], cell[1])]
-                    key = frozenset(value)
-                    if key not in pairs:
-                        pairs[key] = []
-                    pairs[key].append(cell)
-            
-            for key, cells_pair in pairs.items():
-                if len(cells) == 2 and len(key) == 2:
-                    # If there is a naked pair, remove all other occurrences of those values from the group
-                    for cell in cells:
-                        for other_cell in cells_pair:
-                            if cell != other_cell:
-                                to_be_removed = []
-                                for digit in key:
-                                    if digit in domains[(cell[0], cell[1])]:
-                                        changes.append([(cell[0], cell[1]), digit])
-                                        to_be_removed.append(digit)
-                                for x in to_be_removed:
-                                        domains[(cell[0],cell[1])].remove(x)
-                                if len(domains[(cell[0],cell[1])]) == 0:
-                                    kwargs['domains'] = domains
-                                    return False, changes
+    for cells in kwargs.get('geometry', GEOMETRY).units:
+        pairs = {}
+        for cell in cells:
+            if sudoku[cell[0]][cell[1]] == -1:
+                value = domains[(cell[0], cell[1])]
+                key = frozenset(value)
+                if key not in pairs:
+                    pairs[key] = []
+                pairs[key].append(cell)
+        
+        for key, cells_pair in pairs.items():
+            if len(cells_pair) == 2 and len(key) == 2:
+                # If there is a naked pair, remove all other occurrences of those values from the group
+                for cell in cells:
+                    if sudoku[cell[0]][cell[1]] == -1 and cell not in cells_pair:
+                        to_be_removed = []
+                        for digit in key:
+                            if digit in domains[(cell[0], cell[1])]:
+                                changes.append([(cell[0], cell[1]), digit])
+                                to_be_removed.append(digit)
+                        for x in to_be_removed:
+                                domains[(cell[0],cell[1])].remove(x)
+                        if len(domains[(cell[0],cell[1])]) == 0:
+                            kwargs['domains'] = domains
+                            return False, changes
 
     kwargs['domains'] = domains
     return True, changes
-                            
- 
+
+def waterfall2_bitmask(sudoku, **kwargs):
+    '''Naked Pair Inference (waterfall2) for the bitmask backend
+    input:  sudoku: the sudoku to apply the waterfall method on
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the number of changes pushed on kwargs['trail']'''
+    domains = kwargs['domains']
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    geometry = kwargs.get('geometry', GEOMETRY)
+    cell_row, cell_col, popcount = geometry.cell_row, geometry.cell_col, geometry.popcount
+
+    for unit in geometry.unit_indices:
+        empty = [idx for idx in unit if sudoku[cell_row[idx]][cell_col[idx]] == -1]
+        pairs = {}
+        for idx in empty:
+            if popcount[domains[idx]] == 2:
+                pairs.setdefault(domains[idx], []).append(idx)
+
+        for key, cells_pair in pairs.items():
+            if len(cells_pair) == 2:
+                # If there is a naked pair, remove both values from the other unassigned cells of the unit
+                for idx in empty:
+                    if idx not in cells_pair and domains[idx] & key:
+                        trail.remove(idx, domains[idx] & key)
+                        if domains[idx] == 0:
+                            return False, trail.top - checkpoint
+
+    return True, trail.top - checkpoint
+
+def naked_single_waterfall(sudoku, **kwargs):
+    '''Naked Single Inference: a value that is the only one left in the domain of a cell is removed from
+    the other cells of its row, column and box
+    input:  sudoku: the sudoku to apply the waterfall method on
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the changes made to the sudoku'''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return naked_single_waterfall_bitmask(sudoku, **kwargs)
+    domains = kwargs['domains']
+    changes = []
+    for cells in kwargs.get('geometry', GEOMETRY).units:
+        singles = set()
+        for cell in cells:
+            if len(domains[cell]) == 1:
+                value = next(iter(domains[cell]))
+                # Two cells of the unit are left with the same value
+                if value in singles:
+                    return False, changes
+                singles.add(value)
+        if not singles:
+            continue
+        for cell in cells:
+            if len(domains[cell]) > 1:
+                for digit in domains[cell] & singles:
+                    changes.append([cell, digit])
+                domains[cell] -= singles
+                if len(domains[cell]) == 0:
+                    return False, changes
+    return True, changes
+
+def naked_single_waterfall_bitmask(sudoku, **kwargs):
+    '''Naked Single Inference (naked_single_waterfall) for the bitmask backend
+    input:  sudoku: the sudoku to apply the waterfall method on
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the number of changes pushed on kwargs['trail']'''
+    domains = kwargs['domains']
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    geometry = kwargs.get('geometry', GEOMETRY)
+    popcount = geometry.popcount
+    for unit in geometry.unit_indices:
+        singles = 0
+        for idx in unit:
+            mask = domains[idx]
+            if popcount[mask] == 1:
+                if singles & mask:
+                    return False, trail.top - checkpoint
+                singles |= mask
+        if not singles:
+            continue
+        for idx in unit:
+            extra = domains[idx] & singles
+            if extra and popcount[domains[idx]] > 1:
+                trail.remove(idx, extra)
+                if domains[idx] == 0:
+                    return False, trail.top - checkpoint
+    return True, trail.top - checkpoint
+
+def hidden_single_waterfall(sudoku, **kwargs):
+    '''Hidden Single Inference: a value that can only go to one cell of a row, column or box is the value
+    of that cell, the other values are removed from its domain
+    input:  sudoku: the sudoku to apply the waterfall method on
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the changes made to the sudoku'''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return hidden_single_waterfall_bitmask(sudoku, **kwargs)
+    domains = kwargs['domains']
+    changes = []
+    geometry = kwargs.get('geometry', GEOMETRY)
+    for cells in geometry.units:
+        positions = {}
+        for cell in cells:
+            for value in domains[cell]:
+                positions.setdefault(value, []).append(cell)
+        # Every value has to go somewhere in the unit
+        if len(positions) < geometry.size:
+            return False, changes
+        for value, value_cells in positions.items():
+            cell = value_cells[0]
+            if len(value_cells) == 1 and value not in domains[cell]:
+                # Another value can only go to this cell too
+                return False, changes
+            if len(value_cells) == 1 and len(domains[cell]) > 1:
+                for digit in domains[cell]:
+                    if digit != value:
+                        changes.append([cell, digit])
+                domains[cell].intersection_update([value])
+    return True, changes
+
+def hidden_single_waterfall_bitmask(sudoku, **kwargs):
+    '''Hidden Single Inference (hidden_single_waterfall) for the bitmask backend
+    input:  sudoku: the sudoku to apply the waterfall method on
+            kwargs: the kwargs to be passed to the isPossible function
+    output: isPoss: whether the sudoku is still possible to solve (i.e. not inconsistent))
+            changes: the number of changes pushed on kwargs['trail']'''
+    domains = kwargs['domains']
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    geometry = kwargs.get('geometry', GEOMETRY)
+    position_index = kwargs.get('position_index')
+    if position_index is not None:
+        return hidden_single_from_index(sudoku, **kwargs)
+    for unit in geometry.unit_indices:
+        # Values seen in at least one and in at least two cells of the unit
+        once, twice = 0, 0
+        for idx in unit:
+            twice |= once & domains[idx]
+            once |= domains[idx]
+        if once != geometry.all_values:
+            return False, trail.top - checkpoint
+        singles = once & ~twice
+        if not singles:
+            continue
+        for idx in unit:
+            value = domains[idx] & singles
+            if value and domains[idx] != value:
+                # Two values that can only go to this cell
+                if value & (value - 1):
+                    return False, trail.top - checkpoint
+                trail.remove(idx, domains[idx] & ~value)
+    return True, trail.top - checkpoint
+
+def hidden_single_from_index(sudoku, **kwargs):
+    '''hidden_single_waterfall_bitmask reading the positions of every value from kwargs['position_index']'''
+    position_index = kwargs['position_index']
+    domains = kwargs['domains']
+    trail = kwargs['trail']
+    checkpoint = trail.top
+    positions, size = position_index.positions, position_index.size
+    geometry = kwargs.get('geometry', GEOMETRY)
+    lowest_bit = geometry.lowest_bit
+    for unit_id, unit in enumerate(geometry.unit_indices):
+        base = unit_id * size
+        for value in range(size):
+            where = positions[base + value]
+            if where == 0:
+                # No cell left for the value, or two values could only go to the same cell
+                return False, trail.top - checkpoint
+            if where & (where - 1) == 0:
+                idx = unit[lowest_bit[where]]
+                if domains[idx] != 1 << value:
+                    trail.remove(idx, domains[idx] & ~(1 << value))
+    return True, trail.top - checkpoint
+
+# Relative cost of a call of every waterfall with the bitmask backend, measured on the puzzles folder,
+# used by WaterfallScheduler
+WATERFALL_COSTS = {
+    naked_single_waterfall: 2.0,
+    hidden_single_waterfall: 2.0,
+    ac3_waterfall: 1.0,
+    waterfall1: 4.0,
+    waterfall2: 2.5,
+}
+# Calls in a row that find nothing before solve_with_scheduled_waterfalls starts skipping a waterfall
+SCHEDULER_PATIENCE = 8
+
+
 def get_all_waterfall_methods():
     '''Get all the waterfall methods as list.'''
     pass
 
 
-def get_initial_kwargs(sudoku, mrv_on, **kwargs):
+def get_initial_kwargs(sudoku, mrv_on, backend=DEFAULT_BACKEND, incremental_ac3=True, mrv_degree=False,
+                       initial_domains=None, stats=None, position_index=False, backjumping=False, **kwargs):
     '''Get the initial kwargs for the solve_sudoku function.
     input:  sudoku: the sudoku to solve
-            mrv_on: whether to use the mrv heuristic
+            mrv_on: whether to use the mrv heuristic, with the bitmask backend it keeps an MRVIndex up to date
+            backend: SET_BACKEND or BITMASK_BACKEND, how the domains are stored
+            incremental_ac3: whether ac3_waterfall only rechecks the arcs pointing at changed cells
+            mrv_degree: break mrv ties by the degree heuristic (bitmask backend only)
+            initial_domains: domain masks of the empty cells to start from instead of all values,
+                             a list indexed by flat index (bitmask backend only)
+            stats: a SolveStats filled during the search, None for no instrumentation
+            position_index: whether to keep a PositionIndex for the hidden single and hidden pair waterfalls
+                            (bitmask backend only)
+            backjumping: whether to search with conflict-directed backjumping and a NogoodCache, see
+                         BackjumpSearch (bitmask backend only)
             kwargs: other keyword arguments
     output: kwargs: the kwargs to be passed to the solve_sudoku function
     '''
+    n = len(sudoku)
+    kwargs['backend'] = backend
+    kwargs['stats'] = stats
+    kwargs['geometry'] = get_board_geometry(n)
+    # Every cell is changed before the first ac3_waterfall call
+    kwargs['ac3_dirty'] = None
+    if incremental_ac3:
+        kwargs['ac3_dirty'] = set(range(n * n)) if backend == BITMASK_BACKEND else set(kwargs['geometry'].cells)
+    if backend == BITMASK_BACKEND:
+        # The values already placed in every row, column and box, used by isPossible
+        row_used, col_used, box_used = [0] * n, [0] * n, [0] * n
+        domains = [kwargs['geometry'].all_values] * (n * n) if initial_domains is None else list(initial_domains)
+        cell_box = kwargs['geometry'].cell_box
+        for i in range(n):
+            for j in range(n):
+                if sudoku[i][j] != -1:
+                    bit = 1 << sudoku[i][j]
+                    domains[i * n + j] = bit
+                    row_used[i] |= bit
+                    col_used[j] |= bit
+                    box_used[cell_box[i * n + j]] |= bit
+        kwargs['domains'] = domains
+        kwargs['row_used'], kwargs['col_used'], kwargs['box_used'] = row_used, col_used, box_used
+        kwargs['mrv_index'] = MRVIndex(sudoku, mrv_degree, **kwargs) if mrv_on else None
+        kwargs['position_index'] = PositionIndex(**kwargs) if position_index else None
+        kwargs['nogoods'] = NogoodCache() if backjumping else None
+        kwargs['trail'] = Trail(sudoku, **kwargs)
+        return kwargs
+    if backend != SET_BACKEND:
+        raise ValueError('Unknown backend: ' + str(backend))
+    if backjumping:
+        raise ValueError('Backjumping needs the bitmask backend')
+
     domains = {}
-    for i in range(9):
-        for j in range(9):
+    for i in range(n):
+        for j in range(n):
             if sudoku[i][j] == -1:
-                domains[(i, j)] = set(range(9))
+                domains[(i, j)] = set(range(n))
             else:
                 domains[(i, j)] = set([sudoku[i][j]])
     kwargs['domains'] = domains
+    # The domains of the cells assigned by update_changes_for_position, restored when they are undone
+    kwargs['saved_domains'] = {}
     return kwargs
 
 
 
-def solve_plain_backtracking(original_sudoku):
+def run_search(sudoku, x, y, mrv_on, list_of_waterfalls, node_budget=None, deadline=None, **kwargs):
+    '''Run solve_sudoku_iterative with the bitmask backend and solve_sudoku with the set backend,
+    the budgets need the bitmask backend.'''
+    if kwargs.get('backend') == BITMASK_BACKEND:
+        return solve_sudoku_iterative(sudoku, x, y, mrv_on, list_of_waterfalls, node_budget, deadline, **kwargs)
+    if node_budget is not None or deadline is not None:
+        raise ValueError('Node and time budgets need the bitmask backend')
+    return solve_sudoku(sudoku, x, y, mrv_on, list_of_waterfalls, **kwargs)
+
+
+def solve_plain_backtracking(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None, stats=None):
     '''Solve the sudoku using plain backtracking.'''
-    sudoku = copy.deepcopy(original_sudoku)
-    kwargs = get_initial_kwargs(sudoku, False)
+    sudoku = [row[:] for row in original_sudoku]
+    kwargs = get_initial_kwargs(sudoku, False, backend, stats=stats)
     ini_x, ini_y = 0, 0
-    return solve_sudoku(sudoku, ini_x, ini_y, False, [], **kwargs)
+    return run_search(sudoku, ini_x, ini_y, False, [], node_budget, deadline, **kwargs)
 
-def solve_with_mrv(original_sudoku):
+def solve_with_mrv(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None, stats=None):
     '''Solve the sudoku using mrv heuristic.'''
-    sudoku = copy.deepcopy(original_sudoku)
-    kwargs = get_initial_kwargs(sudoku, True)
+    sudoku = [row[:] for row in original_sudoku]
+    kwargs = get_initial_kwargs(sudoku, True, backend, stats=stats)
     ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
-    return solve_sudoku(sudoku, ini_x, ini_y, True, [], **kwargs)
+    return run_search(sudoku, ini_x, ini_y, True, [], node_budget, deadline, **kwargs)
 
-def solve_with_ac3(original_sudoku):
+def solve_with_ac3(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None, stats=None):
     '''Solve the sudoku using mrv heuristic and ac3 waterfall method.'''
-    sudoku = copy.deepcopy(original_sudoku)
+    sudoku = [row[:] for row in original_sudoku]
     all_waterfalls = [ac3_waterfall]
-    kwargs = get_initial_kwargs(sudoku, True)
+    kwargs = get_initial_kwargs(sudoku, True, backend, stats=stats)
     ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
-    return solve_sudoku(sudoku, ini_x, ini_y, True, all_waterfalls, **kwargs)
+    return run_search(sudoku, ini_x, ini_y, True, all_waterfalls, node_budget, deadline, **kwargs)
 
-def solve_with_addition_of_waterfall1(original_sudoku):
+def solve_with_addition_of_waterfall1(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None, stats=None):
     '''Solve the sudoku using mrv heuristic and waterfall1 waterfall method besides ac3.'''
-    sudoku = copy.deepcopy(original_sudoku)
+    sudoku = [row[:] for row in original_sudoku]
     all_waterfalls = [ac3_waterfall, waterfall1]
-    kwargs = get_initial_kwargs(sudoku, True)
+    kwargs = get_initial_kwargs(sudoku, True, backend, stats=stats, position_index=True)
     ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
-    return solve_sudoku(sudoku, ini_x, ini_y, True, all_waterfalls, **kwargs)
+    return run_search(sudoku, ini_x, ini_y, True, all_waterfalls, node_budget, deadline, **kwargs)
 
-def solve_with_addition_of_waterfall2(original_sudoku):
+def solve_with_addition_of_waterfall2(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None, stats=None):
     '''Solve the sudoku using mrv heuristic and waterfall2 waterfall method besides ac3 and waterfall1.'''
-    sudoku = copy.deepcopy(original_sudoku)
+    sudoku = [row[:] for row in original_sudoku]
     all_waterfalls = [ac3_waterfall, waterfall1, waterfall2]
-    kwargs = get_initial_kwargs(sudoku, True)
+    kwargs = get_initial_kwargs(sudoku, True, backend, stats=stats, position_index=True)
     ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
-    return solve_sudoku(sudoku, ini_x, ini_y, True, all_waterfalls, **kwargs)
-
-
-
-def solve_one_puzzle(puzzle_path):
+    return run_search(sudoku, ini_x, ini_y, True, all_waterfalls, node_budget, deadline, **kwargs)
+
+def solve_with_scheduled_waterfalls(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None,
+                                    stats=None):
+    '''Solve the sudoku using mrv heuristic and a WaterfallScheduler over the naked single, hidden single,
+    ac3, waterfall1 and waterfall2 waterfall methods.'''
+    sudoku = [row[:] for row in original_sudoku]
+    all_waterfalls = [naked_single_waterfall, hidden_single_waterfall, ac3_waterfall, waterfall1, waterfall2]
+    kwargs = get_initial_kwargs(sudoku, True, backend, stats=stats, position_index=True)
+    kwargs['scheduler'] = WaterfallScheduler(all_waterfalls, patience=SCHEDULER_PATIENCE)
+    ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+    return run_search(sudoku, ini_x, ini_y, True, all_waterfalls, node_budget, deadline, **kwargs)
+
+def solve_with_backjumping(original_sudoku, backend=DEFAULT_BACKEND, node_budget=None, deadline=None, stats=None):
+    '''Solve the sudoku using mrv heuristic, ac3 and hidden single waterfall methods, conflict-directed
+    backjumping and nogood learning (bitmask backend only).'''
+    sudoku = [row[:] for row in original_sudoku]
+    all_waterfalls = [ac3_waterfall, hidden_single_waterfall]
+    kwargs = get_initial_kwargs(sudoku, True, backend, stats=stats, backjumping=True)
+    ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+    return run_search(sudoku, ini_x, ini_y, True, all_waterfalls, node_budget, deadline, **kwargs)
+
+def iter_solutions(original_sudoku, list_of_waterfalls=None):
+    '''Lazily generate every solution of the sudoku with mrv and list_of_waterfalls
+    ([ac3_waterfall, hidden_single_waterfall] by default) on the bitmask backend
+    input:  original_sudoku: the sudoku to solve, it is not modified
+    output: a generator of the solved sudokus, each a new list of lists'''
+    if list_of_waterfalls is None:
+        list_of_waterfalls = [ac3_waterfall, hidden_single_waterfall]
+    sudoku = [row[:] for row in original_sudoku]
+    kwargs = get_initial_kwargs(sudoku, True, BITMASK_BACKEND, position_index=True)
+    ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+    return SearchState(sudoku, ini_x, ini_y, True, list_of_waterfalls, **kwargs).solutions()
+
+def count_solutions(original_sudoku, limit=2, list_of_waterfalls=None):
+    '''Count the solutions of the sudoku, the search stops as soon as limit solutions are found
+    input:  original_sudoku: the sudoku to check
+            limit: the largest count returned, None for no limit
+            list_of_waterfalls: see iter_solutions
+    output: count: the number of solutions, at most limit'''
+    count = 0
+    if limit is not None and limit <= 0:
+        return count
+    for _ in iter_solutions(original_sudoku, list_of_waterfalls):
+        count += 1
+        if count == limit:
+            break
+    return count
+
+def has_unique_solution(original_sudoku):
+    '''True if the sudoku has exactly one solution'''
+    return count_solutions(original_sudoku, limit=2) == 1
+
+def get_subproblem_kwargs(subproblem):
+    '''Get a copy of the sudoku of a subproblem and the bitmask backend kwargs to search it with mrv'''
+    grid, domains = subproblem
+    sudoku = [row[:] for row in grid]
+    return sudoku, get_initial_kwargs(sudoku, True, BITMASK_BACKEND, initial_domains=domains, position_index=True)
+
+def expand_subproblem(subproblem, list_of_waterfalls):
+    '''Apply the waterfalls to a subproblem and branch on its mrv cell
+    input:  subproblem: (sudoku, domains), domains is a list of masks by flat index or None for all values
+            list_of_waterfalls: the waterfalls applied before branching
+    output: children: a subproblem for every value possible at the mrv cell
+            solution: the solved sudoku if the waterfalls solved it, None otherwise'''
+    sudoku, kwargs = get_subproblem_kwargs(subproblem)
+    isPoss, _ = apply_waterfall_methods(sudoku, list_of_waterfalls, **kwargs)
+    if not isPoss:
+        return [], None
+    if isSolved(sudoku):
+        return [], sudoku
+    x, y = get_mrv_position(sudoku, **kwargs)
+    if sudoku[x][y] != -1:
+        x, y = get_next_position_to_fill(sudoku, x, y, False, **kwargs)
+    trail, candidates = kwargs['trail'], get_candidates_bitmask(x, y, **kwargs)
+    children = []
+    while candidates:
+        trail.assign(x * len(sudoku) + y, kwargs['geometry'].lowest_bit[candidates])
+        children.append(([row[:] for row in sudoku], list(kwargs['domains'])))
+        trail.undo_to(trail.top - 1)
+        candidates &= candidates - 1
+    return children, None
+
+# Nodes a worker of solve_parallel searches between two checks of the stop event
+STOP_CHECK_NODES = 256
+# The event solve_parallel sets to stop its workers, set in every worker by set_stop_event
+_stop_event = None
+
+def set_stop_event(event):
+    '''The initializer of the worker processes of solve_parallel'''
+    global _stop_event
+    _stop_event = event
+
+def solve_subproblem(subproblem, list_of_waterfalls, node_budget):
+    '''Search a subproblem, the task run by the workers of solve_parallel
+    output: solved: True, False, or None if node_budget ran out or the search was stopped
+            sudoku: the solved sudoku, or the subproblems left (see SearchState.split) if the budget ran out
+                    (none when it was stopped)
+            guesses: number of guesses made'''
+    sudoku, kwargs = get_subproblem_kwargs(subproblem)
+    ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+    state = SearchState(sudoku, ini_x, ini_y, True, list_of_waterfalls, **kwargs)
+    if _stop_event is None:
+        solved, sudoku, guesses = state.run(node_budget)
+    else:
+        nodes_left = node_budget
+        while True:
+            solved, sudoku, guesses = state.run(STOP_CHECK_NODES if nodes_left is None
+                                                else min(STOP_CHECK_NODES, nodes_left))
+            if nodes_left is not None:
+                nodes_left -= STOP_CHECK_NODES
+            if solved is not None or (nodes_left is not None and nodes_left <= 0):
+                break
+            if _stop_event.is_set():
+                return None, [], guesses
+    if solved is None:
+        return None, state.split(), guesses
+    return solved, sudoku, guesses
+
+def solve_parallel(original_sudoku, workers=None, list_of_waterfalls=None, node_budget=2000, split_factor=4):
+    '''Solve one sudoku on several processes by splitting its search tree.
+    The top levels of the tree are expanded at the mrv cell until there are split_factor subproblems per
+    worker, every subproblem is a sudoku with its domains. A worker searches a subproblem for at most
+    node_budget nodes; if it does not finish, it sends back the work it has left as new subproblems, so
+    the big subtrees keep being split while the small ones finish. The first solution found is returned
+    at once: the subproblems not started yet are cancelled and the running ones stop within
+    STOP_CHECK_NODES nodes, in the background.
+    input:  original_sudoku: the sudoku to solve
+            workers: number of worker processes, None or 0 uses every cpu, 1 solves in this process
+            list_of_waterfalls: the waterfalls applied at every node, [ac3_waterfall] by default
+            node_budget: the nodes a worker searches before splitting its subproblem again
+            split_factor: the subproblems per worker expanded before the workers start
+    output: solved, sudoku, guesses like the solve_* functions, the guesses are the total over the
+            subproblems searched'''
+    if list_of_waterfalls is None:
+        list_of_waterfalls = [ac3_waterfall]
+    workers = workers or os.cpu_count()
+    guesses = 0
+    frontier = [([row[:] for row in original_sudoku], None)]
+    while 0 < len(frontier) < workers * split_factor:
+        expanded = []
+        for subproblem in frontier:
+            children, solution = expand_subproblem(subproblem, list_of_waterfalls)
+            if solution is not None:
+                return True, solution, guesses
+            guesses += max(len(children) - 1, 0)
+            expanded += children
+        frontier = expanded
+
+    pending = deque(frontier)
+    if workers == 1:
+        while pending:
+            solved, result, subproblem_guesses = solve_subproblem(pending.popleft(), list_of_waterfalls, node_budget)
+            guesses += subproblem_guesses
+            if solved:
+                return True, result, guesses
+            if solved is None:
+                pending.extendleft(reversed(result))
+        return False, [row[:] for row in original_sudoku], guesses
+
+    stop = multiprocessing.Event()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=set_stop_event, initargs=(stop,))
+    running = set()
+    try:
+        while pending or running:
+            # Keep every worker busy with one more task queued behind it
+            while pending and len(running) < 2 * workers:
+                running.add(executor.submit(solve_subproblem, pending.popleft(), list_of_waterfalls, node_budget))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                solved, result, subproblem_guesses = future.result()
+                guesses += subproblem_guesses
+                if solved:
+                    return True, result, guesses
+                if solved is None:
+                    # Split subproblems go first, the queue stays short like a depth first search
+                    pending.extendleft(reversed(result))
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    return False, [row[:] for row in original_sudoku], guesses
+
+
+
+# Nodes DancingLinks.search enters between two checks of its deadline
+DEADLINE_CHECK_NODES = 64
+
+
+class DancingLinks:
+    '''Exact cover matrix of a sudoku for Algorithm X with dancing links. The columns are the constraints
+    (every cell has a value, every row, column and box has every value once), the rows are the
+    (cell, value) choices. Nodes are integers and their links live in flat lists; node 0 is the root,
+    nodes 1 to the number of columns are the column headers, the rest are the 1s of the matrix, four per row.
+    The full matrix of a board size is built once and copied for every solve.
+    '''
 
+    _templates = {}
+
+    def __init__(self, geometry):
+        if geometry.size not in DancingLinks._templates:
+            DancingLinks._templates[geometry.size] = DancingLinks.build(geometry)
+        template = DancingLinks._templates[geometry.size]
+        self.left, self.right, self.up, self.down, self.size = [list(links) for links in template[:5]]
+        self.column, self.row_choice, self.choice_nodes = template[5:]
+        self.geometry = geometry
+        self.guesses = 0
+        # The SolveStats of the solve and the time.monotonic() value the search stops at, set by the caller
+        self.stats = None
+        self.deadline = None
+        self.nodes = 0
+
+    @staticmethod
+    def build(geometry):
+        '''Build the links of the full matrix, see __init__'''
+        n, cells = geometry.size, geometry.num_cells
+        num_columns = 4 * cells
+        left = [num_columns] + list(range(num_columns))
+        right = list(range(1, num_columns + 1)) + [0]
+        up = list(range(num_columns + 1))
+        down = list(range(num_columns + 1))
+        size = [0] * (num_columns + 1)
+        column = list(range(num_columns + 1))
+        row_choice = [None] * (num_columns + 1)
+        choice_nodes = {}
+        for idx in range(cells):
+            row, col, box = geometry.cell_row[idx], geometry.cell_col[idx], geometry.cell_box[idx]
+            for val in range(n):
+                headers = (1 + idx, 1 + cells + row * n + val, 1 + 2 * cells + col * n + val,
+                           1 + 3 * cells + box * n + val)
+                first = len(left)
+                nodes = []
+                for k, header in enumerate(headers):
+                    node = first + k
+                    left.append(first + (k - 1) % 4)
+                    right.append(first + (k + 1) % 4)
+                    # Append at the bottom of the column
+                    up.append(up[header])
+                    down.append(header)
+                    down[up[header]] = node
+                    up[header] = node
+                    column.append(header)
+                    row_choice.append((idx, val))
+                    size[header] += 1
+                    nodes.append(node)
+                choice_nodes[(idx, val)] = nodes[0]
+        return left, right, up, down, size, column, row_choice, choice_nodes
+
+    def cover(self, header):
+        left, right, up, down, size, column = self.left, self.right, self.up, self.down, self.size, self.column
+        right[left[header]] = right[header]
+        left[right[header]] = left[header]
+        i = down[header]
+        while i != header:
+            j = right[i]
+            while j != i:
+                down[up[j]] = down[j]
+                up[down[j]] = up[j]
+                size[column[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def uncover(self, header):
+        left, right, up, down, size, column = self.left, self.right, self.up, self.down, self.size, self.column
+        i = up[header]
+        while i != header:
+            j = left[i]
+            while j != i:
+                size[column[j]] += 1
+                down[up[j]] = j
+                up[down[j]] = j
+                j = left[j]
+            i = up[i]
+        right[left[header]] = header
+        left[right[header]] = header
+
+    def select(self, node):
+        '''Cover the other columns of the row of node, unselect undoes it'''
+        j = self.right[node]
+        while j != node:
+            self.cover(self.column[j])
+            j = self.right[j]
+
+    def unselect(self, node):
+        j = self.left[node]
+        while j != node:
+            self.uncover(self.column[j])
+            j = self.left[j]
+
+    def place_givens(self, sudoku):
+        '''Remove the constraints satisfied by the filled cells, False if two of them conflict'''
+        geometry = self.geometry
+        for idx in range(geometry.num_cells):
+            val = sudoku[geometry.cell_row[idx]][geometry.cell_col[idx]]
+            if val != -1:
+                node = self.choice_nodes[(idx, val)]
+                # A covered column was already satisfied by another given
+                for k in range(4):
+                    header = self.column[node + k]
+                    if self.left[self.right[header]] != header:
+                        return False
+                self.cover(self.column[node])
+                self.select(node)
+        return True
+
+    def search(self, solution):
+        '''Algorithm X on the smallest column
+        input:  solution: list the chosen (idx, val) are appended to
+        output: solved: True if every column got covered, None if the deadline passed (the links are then
+                        left as they are)
+                guesses: counted like solve_sudoku, the number of rows of every chosen column minus one'''
+        right, size, stats = self.right, self.size, self.stats
+        if stats is not None:
+            stats.nodes += 1
+        self.nodes += 1
+        # The clock is read every DEADLINE_CHECK_NODES nodes, a node is much cheaper than the call
+        if self.deadline is not None and self.nodes % DEADLINE_CHECK_NODES == 0 and time.monotonic() >= self.deadline:
+            return None, 0
+        if right[0] == 0:
+            return True, 0
+        header = right[0]
+        best = header
+        while header != 0:
+            if size[header] < size[best]:
+                best = header
+                if size[best] <= 1:
+                    break
+            header = right[header]
+        no_cur_guess = size[best]
+        if no_cur_guess == 0:
+            if stats is not None:
+                stats.contradiction('search')
+            return False, 0
+
+        self.cover(best)
+        node = self.down[best]
+        while node != best:
+            idx, val = self.row_choice[node]
+            solution.append((idx, val))
+            self.select(node)
+            if stats is not None:
+                stats.assign(self.geometry.cell_row[idx], self.geometry.cell_col[idx], val)
+            solved, guesses = self.search(solution)
+            no_cur_guess += guesses
+            if solved or solved is None:
+                return solved, no_cur_guess - 1
+            self.unselect(node)
+            solution.pop()
+            if stats is not None:
+                stats.backtrack(self.geometry.cell_row[idx], self.geometry.cell_col[idx], val)
+            node = self.down[node]
+        self.uncover(best)
+        return False, no_cur_guess - 1
+
+
+def solve_with_exact_cover(original_sudoku, backend=DEFAULT_BACKEND, deadline=None, stats=None):
+    '''Solve the sudoku as an exact cover problem with Algorithm X and dancing links, solved is None if the
+    deadline (a time.monotonic() value) passed first.
+    backend is not used, it is accepted so that the signature matches the other solve_* functions.'''
+    sudoku = [row[:] for row in original_sudoku]
+    geometry = get_board_geometry(len(sudoku))
+    links = DancingLinks(geometry)
+    links.stats = stats
+    links.deadline = deadline
+    if not links.place_givens(sudoku):
+        return False, sudoku, 0
+    solution = []
+    solved, guesses = links.search(solution)
+    if solved:
+        for idx, val in solution:
+            sudoku[geometry.cell_row[idx]][geometry.cell_col[idx]] = val
+    return solved, sudoku, guesses
+
+
+def sudokus_to_candidates(sudokus):
+    '''Get the candidates of a list of sudokus as a boolean numpy array of shape (N, cells, size),
+    candidates[n, idx, v] is True if the value v is not excluded at the flat index idx of the n-th sudoku'''
+    size = len(sudokus[0])
+    grids = np.array(sudokus, dtype=np.int64).reshape(len(sudokus), size * size)
+    candidates = np.ones(grids.shape + (size,), dtype=bool)
+    given = grids >= 0
+    candidates[given] = np.arange(size) == grids[given][:, None]
+    return candidates
+
+
+def propagate_batch(candidates):
+    '''Apply single elimination (the pruning of ac3_waterfall) and hidden singles to every puzzle of the batch
+    at once, until none of them changes anymore
+    input:  candidates: boolean array of shape (N, cells, size), see sudokus_to_candidates
+    output: candidates: the pruned candidates (a new array)
+            status: int8 array of shape (N,), 1 if solved, -1 if inconsistent, 0 if propagation got stuck'''
+    candidates = candidates.copy()
+    geometry = get_board_geometry(candidates.shape[2])
+    peer_matrix, unit_matrix = geometry.peer_matrix, geometry.unit_matrix
+    status = np.zeros(len(candidates), dtype=np.int8)
+    # The puzzles that changed in the last pass, only those are worth another one
+    active = np.arange(len(candidates))
+    while active.size:
+        before = candidates[active]
+        current = before.copy()
+
+        # Remove the value of every cell with a single candidate from its peers
+        singles = current & (current.sum(axis=2) == 1)[:, :, None]
+        current &= ~(np.matmul(peer_matrix, singles.astype(np.float32)) > 0)
+
+        # A value with a single position left in a unit goes there
+        unit_counts = np.matmul(unit_matrix, current.astype(np.float32))
+        only_position = np.matmul(unit_matrix.T, (unit_counts == 1).astype(np.float32)) > 0
+        hidden = current & only_position
+        current = np.where(hidden.any(axis=2)[:, :, None], hidden, current)
+
+        counts = current.sum(axis=2)
+        inconsistent = (counts == 0).any(axis=1) | (unit_counts == 0).any(axis=(1, 2)) | \
+            (hidden.sum(axis=2) > 1).any(axis=1)
+        changed = (current != before).any(axis=(1, 2))
+        candidates[active] = current
+        # Only trust all-single puzzles once a pass found nothing left to remove between their peers
+        solved = ~changed & ~inconsistent & (counts == 1).all(axis=1)
+        status[active[inconsistent]] = -1
+        status[active[solved]] = 1
+        active = active[changed & ~inconsistent]
+    return candidates, status
+
+
+def solve_batch(candidates, list_of_waterfalls=None):
+    '''Solve a batch of puzzles, propagate_batch runs on all of them at once and only the puzzles it cannot
+    finish are searched one by one (with mrv and list_of_waterfalls, [ac3_waterfall] by default)
+    input:  candidates: boolean array of shape (N, cells, size), see sudokus_to_candidates
+    output: a list with the (solved, sudoku, guesses) of every puzzle, like the solve_* functions'''
+    if list_of_waterfalls is None:
+        list_of_waterfalls = [ac3_waterfall]
+    candidates, status = propagate_batch(candidates)
+    size = candidates.shape[2]
+    counts = candidates.sum(axis=2)
+    values = np.where(counts == 1, candidates.argmax(axis=2), -1)
+    masks = candidates.astype(np.int64) @ (1 << np.arange(size, dtype=np.int64))
+
+    results = []
+    for n in range(len(candidates)):
+        sudoku = values[n].reshape(size, size).tolist()
+        if status[n] == 1:
+            results.append((True, sudoku, 0))
+        elif status[n] == -1:
+            results.append((False, sudoku, 0))
+        else:
+            kwargs = get_initial_kwargs(sudoku, True, BITMASK_BACKEND, initial_domains=masks[n].tolist())
+            ini_x, ini_y = get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+            results.append(run_search(sudoku, ini_x, ini_y, True, list_of_waterfalls, **kwargs))
+    return results
+
+
+# The strategies solve_one_puzzle can run, in the order they are run and printed, with their labels
+STRATEGIES = {
+    'backtracking': solve_plain_backtracking,
+    'mrv': solve_with_mrv,
+    'ac3': solve_with_ac3,
+    'waterfall1': solve_with_addition_of_waterfall1,
+    'waterfall2': solve_with_addition_of_waterfall2,
+    'exact_cover': solve_with_exact_cover,
+    'scheduled': solve_with_scheduled_waterfalls,
+    'backjumping': solve_with_backjumping,
+}
+STRATEGY_LABELS = {
+    'backtracking': 'backtracking guesses: ',
+    'mrv': 'mrv guesses: ',
+    'ac3': 'ac3 guesses: ',
+    'waterfall1': 'with waterfall1 guesses: ',
+    'waterfall2': 'with waterfall2 guesses: ',
+    'exact_cover': 'exact cover guesses: ',
+    'scheduled': 'scheduled waterfalls guesses: ',
+    'backjumping': 'backjumping guesses: ',
+}
+# The strategies run when none are given
+DEFAULT_STRATEGIES = ['backtracking', 'mrv', 'ac3', 'waterfall1', 'waterfall2']
+
+
+def solve_one_puzzle(puzzle_path, backend=DEFAULT_BACKEND, strategies=None):
+    '''Solve the puzzle at puzzle_path with every strategy in strategies (names from STRATEGIES, DEFAULT_STRATEGIES by default)
+    and return the number of guesses of each one, in the same order'''
     sudoku = load_sudoku(puzzle_path)
     # print(sudoku)
-
-    solved, solved_sudoku_bt, backtracking_guesses = solve_plain_backtracking(sudoku)
-    assert solved
-    solved, solved_sudoku_mrv, mrv_guesses = solve_with_mrv(sudoku)
-    assert solved
-    solved, solved_sudoku_ac, ac3_guesses = solve_with_ac3(sudoku)
-    assert solved
-    solved, solved_sudoku, waterfall1_guesses = solve_with_addition_of_waterfall1(sudoku)
-    assert solved
-    solved, solved_sudoku, waterfall2_guesses = solve_with_addition_of_waterfall2(sudoku)
-    assert solved
-    #Add more waterfall methods here if you want need to and return the number of guesses for each method
-    return (backtracking_guesses, mrv_guesses, ac3_guesses, waterfall1_guesses, waterfall2_guesses)
-
-def solve_all_sudoku():
-    puzzles_folder = "puzzles"
+    if strategies is None:
+        strategies = DEFAULT_STRATEGIES
+
+    all_guesses = []
+    for name in strategies:
+        solved, solved_sudoku, guesses = STRATEGIES[name](sudoku, backend)
+        assert solved
+        all_guesses.append(guesses)
+    #Add more strategies to STRATEGIES if you want need to, their guesses are returned here too
+    return tuple(all_guesses)
+
+def solve_all_sudoku(puzzles_folder="puzzles", workers=1, chunksize=None, strategies=None, backend=DEFAULT_BACKEND):
+    '''Solve every puzzle in puzzles_folder and print the guesses of every strategy
+    input:  puzzles_folder: the folder with the puzzle files
+            workers: number of worker processes, 1 solves in this process, None or 0 uses every cpu
+            chunksize: number of puzzles sent to a worker at once, by default about 4 chunks per worker
+            strategies: names from STRATEGIES to run, DEFAULT_STRATEGIES by default
+            backend: SET_BACKEND or BITMASK_BACKEND
+    The output is the same whatever the number of workers, the puzzles are printed in sorted order.'''
     puzzles = os.listdir(puzzles_folder)
     puzzles.sort()
-
-    for puzzle_file in puzzles:
-        puzzle_path = os.path.join(puzzles_folder, puzzle_file)
-
-        backtracking_guesses, mrv_guesses, ac3_guesses, waterfall1_guesses, waterfall2_guesses = solve_one_puzzle(puzzle_path)
-        print("Puzzle: ", puzzle_file)
-        print("backtracking guesses: ", backtracking_guesses)
-        print("mrv guesses: ", mrv_guesses)
-        print( "ac3 guesses: ", ac3_guesses)
-        print("with waterfall1 guesses: ", waterfall1_guesses)
-        print("with waterfall2 guesses: ", waterfall2_guesses)
+    if strategies is None:
+        strategies = DEFAULT_STRATEGIES
+    puzzle_paths = [os.path.join(puzzles_folder, puzzle_file) for puzzle_file in puzzles]
+    # Every task loads its puzzle file in the worker and runs all the strategies on it
+    solve = functools.partial(solve_one_puzzle, backend=backend, strategies=strategies)
+
+    executor = None
+    if workers == 1:
+        results = map(solve, puzzle_paths)
+    else:
+        workers = workers or os.cpu_count()
+        if chunksize is None:
+            chunksize = max(1, len(puzzle_paths) // (workers * 4))
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(solve, puzzle_paths, chunksize=chunksize)
+
+    try:
+        # map returns the results in the order of puzzle_paths
+        for puzzle_file, all_guesses in zip(puzzles, results):
+            print("Puzzle: ", puzzle_file)
+            for name, guesses in zip(strategies, all_guesses):
+                print(STRATEGY_LABELS[name], guesses)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 if __name__ == '__main__':
-    solve_all_sudoku()
+    parser = argparse.ArgumentParser(description='Solve every puzzle in a folder and print the guesses of every strategy')
+    parser.add_argument('--puzzles', default='puzzles', help='folder with the puzzle files')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, 0 for one per cpu')
+    parser.add_argument('--chunksize', type=int, default=None, help='puzzles sent to a worker at once')
+    parser.add_argument('--strategies', default=','.join(DEFAULT_STRATEGIES),
+                        help='comma separated strategies out of ' + ', '.join(STRATEGIES))
+    parser.add_argument('--backend', default=DEFAULT_BACKEND, choices=[SET_BACKEND, BITMASK_BACKEND])
+    args = parser.parse_args()
+    strategies = args.strategies.split(',')
+    for name in strategies:
+        if name not in STRATEGIES:
+            parser.error('unknown strategy: ' + name)
+    solve_all_sudoku(args.puzzles, args.workers, args.chunksize, strategies, args.backend)
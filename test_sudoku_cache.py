@@ -0,0 +1,125 @@
+import random
+
+import sudoku_benchmark
+import sudoku_cache
+import sudoku_solver
+
+
+def pattern_solution(box_size):
+    '''A solved n x n grid built from the classic shifted pattern'''
+    n = box_size * box_size
+    return [[(box_size * (row % box_size) + row // box_size + col) % n for col in range(n)] for row in range(n)]
+
+
+def transform(sudoku, rng):
+    '''A random equivalent puzzle: transposed or not, bands, stacks, rows, columns and values shuffled'''
+    n = len(sudoku)
+    box_size = sudoku_solver.get_board_geometry(n).box_size
+    grid = [list(col) for col in zip(*sudoku)] if rng.random() < 0.5 else sudoku
+    values = list(range(n))
+    rng.shuffle(values)
+    rows = [band * box_size + row for band in rng.sample(range(box_size), box_size)
+            for row in rng.sample(range(box_size), box_size)]
+    cols = [stack * box_size + col for stack in rng.sample(range(box_size), box_size)
+            for col in rng.sample(range(box_size), box_size)]
+    return [[-1 if grid[row][col] == -1 else values[grid[row][col]] for col in cols] for row in rows]
+
+
+def assert_solves(puzzle, solution):
+    geometry = sudoku_solver.get_board_geometry(len(puzzle))
+    for unit in geometry.units:
+        assert sorted(solution[row][col] for row, col in unit) == list(range(geometry.size))
+    for row, col in geometry.cells:
+        assert puzzle[row][col] in (-1, solution[row][col])
+
+
+def make_puzzle(solution, clues, rng):
+    n = len(solution)
+    puzzle = [row[:] for row in solution]
+    for idx in rng.sample(range(n * n), n * n - clues):
+        puzzle[idx // n][idx % n] = -1
+    return puzzle
+
+
+def test_transformed_puzzle_hits():
+    rng = random.Random(0)
+    cache = sudoku_cache.SolutionCache()
+    for puzzle in sudoku_benchmark.generate_corpus('hard', 5):
+        solved, solution, guesses = cache.solve(puzzle)
+        assert solved
+        assert_solves(puzzle, solution)
+        misses = cache.misses
+        for _ in range(3):
+            equivalent = transform(puzzle, rng)
+            solved, solution, guesses = cache.solve(equivalent)
+            assert solved and guesses == 0
+            assert_solves(equivalent, solution)
+        assert cache.misses == misses
+    assert cache.hits == 15
+
+
+def test_exact_hit_returns_a_copy():
+    cache = sudoku_cache.SolutionCache()
+    puzzle = sudoku_benchmark.generate_corpus('easy', 1)[0]
+    first = cache.solve(puzzle)[1]
+    first[0][0] = -1
+    solved, second, guesses = cache.solve(puzzle)
+    assert solved and cache.hits == 1
+    assert_solves(puzzle, second)
+
+
+def test_unsolvable_puzzle_is_cached():
+    cache = sudoku_cache.SolutionCache()
+    puzzle = sudoku_benchmark.generate_corpus('easy', 1)[0]
+    row = puzzle[0]
+    clue = next(col for col in range(9) if row[col] != -1)
+    row[next(col for col in range(9) if row[col] == -1)] = row[clue]
+    assert cache.solve(puzzle)[0] is False
+    assert cache.misses == 1
+    solved, sudoku, guesses = cache.solve(puzzle)
+    assert solved is False and sudoku == puzzle
+    solved, sudoku, guesses = cache.solve(transform(puzzle, random.Random(1)))
+    assert solved is False
+    assert cache.hits == 2 and cache.misses == 1
+
+
+def test_sqlite_persists_between_caches(tmp_path):
+    path = str(tmp_path / 'solutions.db')
+    puzzles = sudoku_benchmark.generate_corpus('medium', 3)
+    cache = sudoku_cache.SolutionCache(path)
+    for puzzle in puzzles:
+        assert cache.solve(puzzle)[0]
+    cache.close()
+
+    rng = random.Random(2)
+    cache = sudoku_cache.SolutionCache(path)
+    for puzzle in puzzles:
+        equivalent = transform(puzzle, rng)
+        solved, solution, guesses = cache.solve(equivalent, strategy=None)
+        assert solved
+        assert_solves(equivalent, solution)
+    assert cache.hits == 3 and cache.misses == 0
+    cache.close()
+
+
+def test_16x16_board():
+    rng = random.Random(3)
+    cache = sudoku_cache.SolutionCache()
+    puzzle = make_puzzle(pattern_solution(4), 200, rng)
+    solved, solution, guesses = cache.solve(puzzle)
+    assert solved
+    assert_solves(puzzle, solution)
+    equivalent = transform(puzzle, rng)
+    solved, solution, guesses = cache.solve(equivalent)
+    assert solved and cache.misses == 1
+    assert_solves(equivalent, solution)
+
+
+def test_symmetric_large_boards_are_bounded():
+    # Empty and complete boards tie every row, their orders are only enumerated up to the cap
+    for box_size in (4, 5):
+        n = box_size * box_size
+        for grid in ([[-1] * n for _ in range(n)], pattern_solution(box_size)):
+            key, (transposed, row_order, col_order, labels) = sudoku_cache.canonical_form(grid)
+            assert len(key) == n * n
+            assert sorted(row_order) == list(range(n)) and sorted(col_order) == list(range(n))
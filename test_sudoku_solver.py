@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+import sudoku_benchmark
+import sudoku_solver
+
+
+def assert_solves(puzzle, solution):
+    geometry = sudoku_solver.get_board_geometry(len(puzzle))
+    for unit in geometry.units:
+        assert sorted(solution[row][col] for row, col in unit) == list(range(geometry.size))
+    for row, col in geometry.cells:
+        assert puzzle[row][col] in (-1, solution[row][col])
+
+
+def generated_puzzles(rng, clues, count, unsolvable=0):
+    '''Puzzles made by emptying random cells of random solutions; the first unsolvable of them get a clue
+    changed, which leaves them without a solution unless the change happens to fit another one'''
+    puzzles = []
+    for _ in range(count):
+        puzzle = sudoku_benchmark.random_solution(rng)
+        for idx in rng.sample(range(81), 81 - clues):
+            puzzle[idx // 9][idx % 9] = -1
+        puzzles.append(puzzle)
+    for puzzle in puzzles[:unsolvable]:
+        row, col = rng.choice([(row, col) for row in range(9) for col in range(9) if puzzle[row][col] != -1])
+        puzzle[row][col] = (puzzle[row][col] + rng.randrange(1, 9)) % 9
+    return puzzles
+
+
+def random_clue_puzzles(rng, clues, count):
+    '''Puzzles with clues placed at random without a conflict between them, most have no solution'''
+    puzzles = []
+    for _ in range(count):
+        puzzle = [[-1] * 9 for _ in range(9)]
+        kwargs = sudoku_solver.get_initial_kwargs(puzzle, False, sudoku_solver.BITMASK_BACKEND)
+        placed = 0
+        while placed < clues:
+            row, col, val = rng.randrange(9), rng.randrange(9), rng.randrange(9)
+            if puzzle[row][col] == -1 and sudoku_solver.isPossible(puzzle, row, col, val, **kwargs):
+                sudoku_solver.update_changes_for_position(puzzle, row, col, val, **kwargs)
+                placed += 1
+        puzzles.append(puzzle)
+    return puzzles
+
+
+def backjump_search(puzzle):
+    sudoku = [row[:] for row in puzzle]
+    kwargs = sudoku_solver.get_initial_kwargs(sudoku, True, sudoku_solver.BITMASK_BACKEND, backjumping=True)
+    x, y = sudoku_solver.get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+    return sudoku_solver.BackjumpSearch(sudoku, x, y, True, [sudoku_solver.ac3_waterfall,
+                                                              sudoku_solver.hidden_single_waterfall], **kwargs)
+
+
+@pytest.mark.parametrize('clues', [17, 20, 24])
+def test_backjumping_matches_exact_cover(clues):
+    rng = random.Random(clues)
+    puzzles = generated_puzzles(rng, clues, 12, unsolvable=4) + random_clue_puzzles(rng, clues, 12)
+    outcomes = set()
+    for puzzle in puzzles:
+        expected = sudoku_solver.solve_with_exact_cover(puzzle)[0]
+        solved, solution, guesses = sudoku_solver.solve_with_backjumping(puzzle)
+        assert solved == expected
+        if solved:
+            assert_solves(puzzle, solution)
+        outcomes.add(solved)
+    assert outcomes == {True, False}
+
+
+def test_backjumping_enumerates_every_solution():
+    rng = random.Random(30)
+    total = 0
+    for puzzle in generated_puzzles(rng, 30, 12):
+        solutions = list(backjump_search(puzzle).solutions())
+        for solution in solutions:
+            assert_solves(puzzle, solution)
+        assert len({str(solution) for solution in solutions}) == len(solutions)
+        assert len(solutions) == sudoku_solver.count_solutions(puzzle, limit=None, list_of_waterfalls=[])
+        total += len(solutions)
+    assert total > 12
+
+
+def test_nogood_cache_is_bounded():
+    # A puzzle plain ac3 search needs hundreds of thousands of guesses for, backjumping learns many nogoods
+    line = '.....6....59.....82....8....45........3........6..3.54...325..6..................'
+    puzzle = [[-1 if char == '.' else int(char) - 1 for char in line[row * 9:row * 9 + 9]] for row in range(9)]
+    cache = sudoku_solver.NogoodCache(max_size=16, max_length=6)
+    sudoku = [row[:] for row in puzzle]
+    kwargs = sudoku_solver.get_initial_kwargs(sudoku, True, sudoku_solver.BITMASK_BACKEND, backjumping=True)
+    kwargs['nogoods'] = cache
+    x, y = sudoku_solver.get_next_position_to_fill(sudoku, -1, -1, True, **kwargs)
+    solved, solution, guesses = sudoku_solver.BackjumpSearch(
+        sudoku, x, y, True, [sudoku_solver.ac3_waterfall, sudoku_solver.hidden_single_waterfall], **kwargs).run()
+    assert solved
+    assert_solves(puzzle, solution)
+    assert cache.evicted > 0 and len(cache) == 16 and cache.learned == len(cache) + cache.evicted
+    assert all(len(nogood) <= 6 for nogood in cache.entries)